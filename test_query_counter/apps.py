@@ -1,6 +1,11 @@
 # -*- coding: utf-8
+import functools
+import sys
+from types import MappingProxyType
+
 from django.apps import AppConfig
 from django.conf import settings
+from django.core.signals import setting_changed
 
 
 class RequestQueryCountConfig(AppConfig):
@@ -9,27 +14,153 @@ class RequestQueryCountConfig(AppConfig):
 
     setting_name = 'TEST_QUERY_COUNTER'
 
+    DETAIL_LEVEL_QUERIES = 'queries'
+    DETAIL_LEVEL_COUNT = 'count'
+
     default_settings = {
         'ENABLE': True,
         'ENABLE_STACKTRACES': True,
+        'DETAIL_LEVEL': DETAIL_LEVEL_QUERIES,
+        'CAPTURE': 'debug_cursor',
+        'CAPTURE_TEST_BODY': False,
+        'DATABASES': None,
+        'KEY_BY': 'path',
+        'REQUEST_KEY': None,
+        'EXCLUDE': [],
+        'FORMAT': 'json',
+        'MERGE': False,
+        'BASELINE_PATH': None,
+        'BASELINE_THRESHOLD': 10,
         'DETAIL_PATH': 'reports/query_count_detail.json',
         'SUMMARY_PATH': 'reports/query_count.json'
     }
 
+    resolved_settings = None
+    exclusion_matcher = None
+
+    @classmethod
+    def get_settings(cls):
+        """
+        Returns a read-only mapping of the settings merged with the defaults,
+        resolved only once until the settings change
+        """
+        if cls.resolved_settings is None:
+            resolved_settings = dict(cls.default_settings)
+            resolved_settings.update(getattr(settings, cls.setting_name, {}))
+            cls.resolved_settings = MappingProxyType(resolved_settings)
+        return cls.resolved_settings
+
     @classmethod
     def get_setting(cls, setting_name):
-        return (getattr(settings, cls.setting_name, {})
-                .get(setting_name, cls.default_settings[setting_name]))
+        return cls.get_settings()[setting_name]
 
     @classmethod
     def stacktraces_enabled(cls):
         return cls.get_setting('ENABLE_STACKTRACES')
 
+    @classmethod
+    def detail_enabled(cls):
+        return cls.get_setting('DETAIL_LEVEL') != cls.DETAIL_LEVEL_COUNT
+
     @classmethod
     def enabled(cls):
         return cls.get_setting('ENABLE')
 
+    @classmethod
+    def get_databases(cls):
+        """Returns the aliases of the databases whose queries are counted"""
+        from django.db import connections
+        return cls.get_setting('DATABASES') or list(connections)
+
+    @classmethod
+    def get_exclusion_matcher(cls):
+        """
+        Returns a QueryCountExclusionMatcher for the EXCLUDE setting rules,
+        compiled only once. Each rule is either a path regex, or a dictionary
+        with 'path' and/or 'method' regexes.
+        """
+        if cls.exclusion_matcher is None:
+            from test_query_counter.query_count import (
+                ANY, QueryCountExclusion, QueryCountExclusionMatcher
+            )
+
+            exclusions = []
+            for rule in cls.get_setting('EXCLUDE'):
+                if isinstance(rule, str):
+                    rule = {'path': rule}
+                exclusions.append(QueryCountExclusion(
+                    rule.get('path', ANY), rule.get('method', ANY),
+                    sys.maxsize
+                ))
+            cls.exclusion_matcher = QueryCountExclusionMatcher(exclusions)
+        return cls.exclusion_matcher
+
+    @classmethod
+    def on_setting_changed(cls, setting, **kwargs):
+        if setting == cls.setting_name:
+            cls.resolved_settings = None
+            cls.exclusion_matcher = None
+        elif setting == 'ROOT_URLCONF':
+            from test_query_counter.request_keys import resolve_path
+            resolve_path.cache_clear()
+
+    @classmethod
+    def wrap_setup_test_environment(cls, func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            result = func(*args, **kwargs)
+            # Settings are only overridden in the tests
+            setting_changed.connect(cls.on_setting_changed)
+            if cls.enabled():
+                from test_query_counter.manager import RequestQueryCountManager
+                RequestQueryCountManager.start_test_run()
+            return result
+
+        wrapped.query_count_wrapped = True
+        return wrapped
+
+    @classmethod
+    def wrap_teardown_test_environment(cls, func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            result = func(*args, **kwargs)
+            if cls.enabled():
+                from test_query_counter.manager import RequestQueryCountManager
+                RequestQueryCountManager.finish_test_run()
+            return result
+
+        wrapped.query_count_wrapped = True
+        return wrapped
+
+    @classmethod
+    def patch_test_environment(cls):
+        """
+        Defers the set up of the query count until a test run sets up the test
+        environment, as the Django runner, any runner extending it, and
+        pytest-django do. Other processes loading the app, like the web
+        servers or the task workers, get neither the middleware nor the
+        patched test cases.
+
+        Only the functions of the django.test modules already imported are
+        wrapped, so the app doesn't import django.test. Otherwise, the test
+        runner must call it before setting up the test environment, as
+        test_query_counter.runner.QueryCountDiscoverRunner does.
+        """
+        # django.test.runner binds the functions on import, so they are
+        # wrapped there too if it was imported
+        for module_name in ('django.test.utils', 'django.test.runner'):
+            module = sys.modules.get(module_name)
+            if module is None:
+                continue
+            for name, wrap in (
+                ('setup_test_environment', cls.wrap_setup_test_environment),
+                ('teardown_test_environment',
+                 cls.wrap_teardown_test_environment),
+            ):
+                func = getattr(module, name)
+                if not getattr(func, 'query_count_wrapped', False):
+                    setattr(module, name, wrap(func))
+
     def ready(self):
         if self.enabled():
-            from test_query_counter.manager import RequestQueryCountManager
-            RequestQueryCountManager.set_up()
+            self.patch_test_environment()
@@ -0,0 +1,147 @@
+import time
+from itertools import islice
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_started
+from django.db import reset_queries
+
+
+class DebugCursorCapture(object):
+    """
+    Captures the queries of a connection by forcing its debug cursor, and
+    reading them back from the connection queries log.
+
+    Took from django.test.utils.CaptureQueriesContext
+    """
+
+    # Number of started captures, the queries log must not be reset on new
+    # requests until all of them stop
+    active_captures = 0
+
+    def __init__(self, connection, detail):
+        """
+        :param connection: database connection to capture
+        :param detail: if True, the captured queries are returned, otherwise
+            only the number of captured queries
+        """
+        self.connection = connection
+        self.detail = detail
+        self.force_debug_cursor = False
+        self.initial_queries = 0
+        self.queries = []
+        self.count = 0
+
+    def start(self):
+        self.force_debug_cursor = self.connection.force_debug_cursor
+        self.connection.force_debug_cursor = True
+        self.initial_queries = len(self.connection.queries_log)
+        self.queries = []
+        self.count = 0
+        if DebugCursorCapture.active_captures == 0:
+            request_started.disconnect(reset_queries)
+        DebugCursorCapture.active_captures += 1
+
+    def collect(self):
+        """Collects the queries logged since start or resume"""
+        final_queries = len(self.connection.queries_log)
+        if self.detail:
+            self.queries.extend(
+                islice(self.connection.queries_log, self.initial_queries,
+                       final_queries)
+            )
+        else:
+            self.count += final_queries - self.initial_queries
+        self.initial_queries = final_queries
+
+    def pause(self):
+        """Stops collecting queries until resume is called"""
+        self.collect()
+
+    def resume(self):
+        self.initial_queries = len(self.connection.queries_log)
+
+    def stop(self):
+        """Returns the queries, or number of queries, made since start"""
+        self.connection.force_debug_cursor = self.force_debug_cursor
+        DebugCursorCapture.active_captures -= 1
+        if DebugCursorCapture.active_captures == 0:
+            request_started.connect(reset_queries)
+        self.collect()
+        if self.detail:
+            return self.queries
+        return self.count
+
+
+class ExecuteWrapperCapture(object):
+    """
+    Captures the queries of a connection with an execute wrapper. Unlike
+    DebugCursorCapture, the SQL is recorded without its params, and the count
+    is not bounded by the size of the connection queries log.
+    """
+
+    def __init__(self, connection, detail):
+        """
+        :param connection: database connection to capture
+        :param detail: if True, the captured queries are returned, otherwise
+            only the number of captured queries
+        """
+        self.connection = connection
+        self.detail = detail
+        self.queries = []
+        self.count = 0
+        self.paused = False
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.paused:
+            return execute(sql, params, many, context)
+
+        self.count += 1
+        if not self.detail:
+            return execute(sql, params, many, context)
+
+        start = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'sql': sql,
+                'time': '%.3f' % (time.monotonic() - start),
+            })
+
+    def start(self):
+        self.queries = []
+        self.count = 0
+        self.paused = False
+        self.connection.execute_wrappers.append(self)
+
+    def pause(self):
+        """Stops collecting queries until resume is called"""
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def stop(self):
+        """Returns the queries, or number of queries, made since start"""
+        self.connection.execute_wrappers.remove(self)
+        if self.detail:
+            return self.queries
+        return self.count
+
+
+CAPTURE_CLASSES = {
+    'debug_cursor': DebugCursorCapture,
+    'execute_wrapper': ExecuteWrapperCapture,
+}
+
+
+def get_capture_class(name):
+    """Returns the capture class for a CAPTURE setting value"""
+    try:
+        return CAPTURE_CLASSES[name]
+    except KeyError:
+        raise ImproperlyConfigured(
+            'Unknown query capture {!r}. Choices are: {}.'.format(
+                name, ', '.join(sorted(CAPTURE_CLASSES))
+            )
+        )
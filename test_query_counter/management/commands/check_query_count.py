@@ -1,7 +1,11 @@
+import re
+
 from django.core.management import BaseCommand, CommandError
 
 from test_query_counter.apps import RequestQueryCountConfig
-from test_query_counter.query_count import QueryCountEvaluator
+from test_query_counter.query_count import (QueryCountBudget,
+                                            QueryCountEvaluator)
+from test_query_counter.reports import open_report
 
 
 class Command(BaseCommand):
@@ -17,13 +21,13 @@ class Command(BaseCommand):
         super().add_arguments(parser)
         parser.add_argument('--last-count-file',
                             dest='last_count_file',
-                            help='JSON summary file to compare against.',
+                            help='Summary file to compare against.',
                             required=True)
 
         summary_path = RequestQueryCountConfig.get_setting('SUMMARY_PATH')
         parser.add_argument('--query-count-file',
                             dest='query_count_file',
-                            help='JSON summary file for current run.',
+                            help='Summary file for current run.',
                             default=summary_path)
 
         help_msg = 'Threshold tolerance, which is computed in percentage. ' \
@@ -33,11 +37,65 @@ class Command(BaseCommand):
                             type=float, default=self.INCREASE_THRESHOLD,
                             help=help_msg)
 
+        parser.add_argument('--query-time-threshold',
+                            dest='query_time_threshold',
+                            type=float, default=None,
+                            help='Threshold tolerance for the total time of '
+                                 'the queries, which is computed in '
+                                 'percentage. Increases below 0.05s are '
+                                 'tolerated. Query times are not checked '
+                                 'unless given.')
+
+        parser.add_argument('--duplicate-query-threshold',
+                            dest='duplicate_query_threshold',
+                            type=int, default=None,
+                            help='Maximum number of queries of the same '
+                                 'shape allowed in an API call, which are '
+                                 'usually caused by N+1 problems. Repeated '
+                                 'queries are not checked unless given.')
+
+        parser.add_argument('--budget-file',
+                            dest='budget_file', default=None,
+                            help='JSON file with the maximum number of '
+                                 'queries of the API calls, as a list of '
+                                 'objects with a "count", and optionally '
+                                 '"path" and "method" regexes. The first one '
+                                 'that matches an API call applies, even to '
+                                 'API calls that are new since the last run.')
+
+        parser.add_argument('--stream',
+                            dest='stream', action='store_true',
+                            help='Read the summary files incrementally and '
+                                 'print each violation as soon as it is '
+                                 'found, instead of loading the files in '
+                                 'memory.')
+
+    @classmethod
+    def load_budgets(cls, path):
+        if path is None:
+            return None
+        try:
+            with open(path) as budget_file:
+                return QueryCountBudget.load(budget_file)
+        except (AttributeError, KeyError, OSError, TypeError, ValueError,
+                re.error) as error:
+            raise CommandError(
+                'Invalid budget file {}: {}'.format(path, error)
+            )
+
     def handle(self, *args, **options):
-        with open(options['query_count_file']) as current_file, \
-                open(options['last_count_file']) as last_file:
-            violations = QueryCountEvaluator(options['query_count_threshold'],
-                                             current_file, last_file).run()
+        budgets = self.load_budgets(options['budget_file'])
+        current_file = open_report(options['query_count_file'],
+                                   options['stream'])
+        last_file = open_report(options['last_count_file'], options['stream'])
+        with current_file, last_file:
+            evaluator = QueryCountEvaluator(
+                options['query_count_threshold'], current_file, last_file,
+                time_threshold=options['query_time_threshold'],
+                duplicate_threshold=options['duplicate_query_threshold'],
+                budgets=budgets
+            )
+            violations = sum(1 for _ in evaluator.iter_run())
 
             if violations:
                 raise CommandError('There was at least one test with an API '
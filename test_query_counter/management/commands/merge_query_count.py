@@ -0,0 +1,152 @@
+from collections import Counter
+
+from django.core.management import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from test_query_counter.apps import RequestQueryCountConfig
+from test_query_counter.query_count import (TestCaseQueryContainer,
+                                            TestResultQueryContainer)
+from test_query_counter.reports import (REPORT_CLASSES, get_report_class,
+                                        open_report)
+
+
+class Command(BaseCommand):
+
+    help = 'Merges the query count files of several partial runs, e.g. the ' \
+           'shards of a test suite, into one. Test cases found in more than ' \
+           'one file are merged.'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('report_paths', nargs='+', metavar='report',
+                            help='Summary or detail files to merge.')
+
+        parser.add_argument('--output',
+                            dest='output', required=True,
+                            help='File to write the merged count into.')
+
+        parser.add_argument('--format',
+                            dest='format', choices=sorted(REPORT_CLASSES),
+                            default=RequestQueryCountConfig.get_setting(
+                                'FORMAT'),
+                            help='Format of the merged count file. Defaults '
+                                 'to the FORMAT setting.')
+
+    @classmethod
+    def index_test_cases(cls, reports):
+        """Returns the indexes of the reports including each test case id"""
+        report_indexes_by_id = {}
+        for index, report in enumerate(reports):
+            for test_case in report.iter_test_cases():
+                report_indexes = report_indexes_by_id.setdefault(
+                    test_case['id'], []
+                )
+                if report_indexes[-1:] != [index]:
+                    report_indexes.append(index)
+        return report_indexes_by_id
+
+    @classmethod
+    def merge_api_calls(cls, elements):
+        """
+        Returns the JSON representation of an API call found in several
+        summary files, merged field by field, as its queries are not available
+        :param elements: JSON representations of the API call
+        """
+        merged = {
+            'method': elements[0]['method'],
+            'path': elements[0]['path'],
+            'database': elements[0].get('database', DEFAULT_DB_ALIAS),
+            'total': sum(element['total'] for element in elements),
+        }
+        if all('time' in element for element in elements):
+            times = [element['time'] for element in elements]
+            merged['time'] = {
+                'total': round(sum(time['total'] for time in times), 3),
+                'max': max(time['max'] for time in times),
+                # The percentile of the merged queries can't be computed
+                # without them, the highest one is an upper bound
+                'p95': max(time['p95'] for time in times),
+            }
+        if all('duplicates' in element for element in elements):
+            shapes = Counter()
+            for element in elements:
+                for duplicate in element['duplicates']:
+                    shapes[duplicate['sql']] += duplicate['count']
+            merged['duplicates'] = [
+                {'sql': shape, 'count': count}
+                for shape, count in shapes.most_common()
+            ]
+        return merged
+
+    @classmethod
+    def merge_test_cases(cls, test_case_id, test_cases):
+        """
+        Returns the JSON representation of a test case found in several
+        reports, merged as TestResultQueryContainer.add does
+        """
+        detail = all(
+            'queries' in element
+            for test_case in test_cases
+            for element in test_case['queries']
+        )
+        if detail:
+            result = TestResultQueryContainer()
+            for test_case in test_cases:
+                result.add(test_case_id,
+                           TestCaseQueryContainer.from_json(test_case, True))
+            return result.test_case_json(
+                test_case_id, result.queries_by_testcase[test_case_id], True
+            )
+
+        elements_by_api_call = {}
+        for test_case in test_cases:
+            for element in test_case['queries']:
+                api_call = (element['method'], element['path'],
+                            element.get('database', DEFAULT_DB_ALIAS))
+                elements_by_api_call.setdefault(api_call, []).append(element)
+        queries = [
+            cls.merge_api_calls(elements)
+            for elements in elements_by_api_call.values()
+        ]
+        return {
+            'id': test_case_id,
+            'queries': queries,
+            'total': sum(element['total'] for element in queries),
+        }
+
+    def iter_test_cases(self, reports):
+        """
+        Yields the JSON representation of the test cases of the reports, one
+        at a time, in the order they are found
+        """
+        report_indexes_by_id = self.index_test_cases(reports)
+        for report in reports:
+            for test_case in report.iter_test_cases():
+                test_case_id = test_case['id']
+                report_indexes = report_indexes_by_id.pop(test_case_id, None)
+                if report_indexes is None:
+                    # Already merged with its first appearance
+                    continue
+                if len(report_indexes) > 1:
+                    self.stderr.write(
+                        'Test case {} found in {} files, merging '
+                        'them.'.format(test_case_id, len(report_indexes))
+                    )
+                    test_case = self.merge_test_cases(test_case_id, [
+                        reports[index].get_test_case(test_case_id)
+                        for index in report_indexes
+                    ])
+                yield test_case
+
+    def handle(self, *args, **options):
+        report_class = get_report_class(options['format'])
+        reports = [
+            open_report(report_path, stream=True)
+            for report_path in options['report_paths']
+        ]
+        try:
+            report_class.write(options['output'],
+                               self.iter_test_cases(reports))
+        finally:
+            for report in reports:
+                report.close()
@@ -1,28 +1,163 @@
 # -*- coding: utf-8
+import functools
 import inspect
-import json
 import os
 import os.path
 import threading
+from contextvars import ContextVar
 
 from django.conf import settings
+from django.db import connections
 from django.test import SimpleTestCase
-from django.test.utils import get_runner
+from django.test.runner import ParallelTestSuite, RemoteTestResult
 from django.utils.module_loading import import_string
 from test_query_counter.apps import RequestQueryCountConfig
-from test_query_counter.query_count import (TestCaseQueryContainer,
-                                            TestResultQueryContainer)
+from test_query_counter.capture import (ExecuteWrapperCapture,
+                                        get_capture_class)
+from test_query_counter.query_count import (QueryCountEvaluator,
+                                            QueryCountExclusionMatcher,
+                                            TestCaseQueryContainer,
+                                            TestCaseQueryCountContainer,
+                                            TestResultQueryContainer,
+                                            Violation)
+from test_query_counter.reports import get_report_class, open_report
 
-local = threading.local()
+# The state of the running test is kept in context variables, so it follows
+# the test into the threads and event loops of sync_to_async and
+# async_to_sync, e.g. with AsyncClient and async views
+testcase_container_var = ContextVar('querycount_test_case_container',
+                                    default=None)
+captures_stack_var = ContextVar('querycount_captures_stack', default=None)
+testcase_id_var = ContextVar('querycount_test_case_id', default=None)
+testcase_baseline_var = ContextVar('querycount_test_case_baseline',
+                                   default=None)
+context_vars = {
+    context_var.name: context_var
+    for context_var in (testcase_container_var, captures_stack_var,
+                        testcase_id_var, testcase_baseline_var)
+}
 
 
 class RequestQueryCountManager(object):
-    LOCAL_TESTCASE_CONTAINER_NAME = 'querycount_test_case_container'
+    LOCAL_TESTCASE_CONTAINER_NAME = testcase_container_var.name
+    LOCAL_CAPTURES_STACK_NAME = captures_stack_var.name
+    LOCAL_TESTCASE_ID_NAME = testcase_id_var.name
+    LOCAL_TESTCASE_BASELINE_NAME = testcase_baseline_var.name
+    LOCAL_TESTCASE_STATE_NAMES = (LOCAL_TESTCASE_CONTAINER_NAME,
+                                  LOCAL_CAPTURES_STACK_NAME,
+                                  LOCAL_TESTCASE_ID_NAME,
+                                  LOCAL_TESTCASE_BASELINE_NAME)
+    # State of the running test shared with the threads that don't run it,
+    # e.g. the LiveServerTestCase server threads
+    SHARED_STATE_NAMES = (LOCAL_TESTCASE_CONTAINER_NAME,
+                          LOCAL_TESTCASE_ID_NAME,
+                          LOCAL_TESTCASE_BASELINE_NAME)
+    OUTER_TESTCASE_STATE_NAME = '__querycount_outer_state__'
+    TEST_BODY_METHOD = 'TEST'
+    TEST_BODY_PATH = '<body>'
+    EXCLUSION_MATCHERS_NAME = '__querycount_matchers__'
+    PARALLEL_EVENT_NAME = 'addQueryCount'
     queries = None
+    baseline = None
+    shared_state = {}
+    # Protects the shared state, and the containers of the tests, which the
+    # server threads add queries to
+    lock = threading.RLock()
+    is_set_up = False
+
+    @classmethod
+    def get_local(cls, name):
+        """
+        Returns a value of the state of the running test. Threads that don't
+        run the test get the one shared by the active test.
+        """
+        value = context_vars[name].get()
+        if value is None and name in cls.SHARED_STATE_NAMES:
+            with cls.lock:
+                value = cls.shared_state.get(name)
+        return value
+
+    @classmethod
+    def set_local(cls, name, value):
+        context_vars[name].set(value)
+
+    @classmethod
+    def share_state(cls, state):
+        """Shares the state of the active test with the rest of threads"""
+        with cls.lock:
+            cls.shared_state = {
+                name: state.get(name) for name in cls.SHARED_STATE_NAMES
+            }
 
     @classmethod
     def get_testcase_container(cls):
-        return getattr(local, cls.LOCAL_TESTCASE_CONTAINER_NAME, None)
+        return cls.get_local(cls.LOCAL_TESTCASE_CONTAINER_NAME)
+
+    @classmethod
+    def get_captures_stack(cls):
+        """
+        Returns the captures started in the running test, innermost last.
+        Only the innermost captures are collecting queries, so each query is
+        counted once.
+        """
+        captures_stack = cls.get_local(cls.LOCAL_CAPTURES_STACK_NAME)
+        if captures_stack is None:
+            captures_stack = []
+            cls.set_local(cls.LOCAL_CAPTURES_STACK_NAME, captures_stack)
+        return captures_stack
+
+    @classmethod
+    def start_captures(cls, container, databases=None, capture_class=None):
+        """
+        Starts capturing queries, pausing the enclosing captures until
+        stop_captures is called
+        :param container: TestCaseQueryContainer the queries are meant for
+        :param databases: aliases of the databases to capture. Defaults to
+            the DATABASES setting
+        :param capture_class: class of the captures. Defaults to the one of
+            the CAPTURE setting
+        """
+        if databases is None:
+            databases = RequestQueryCountConfig.get_databases()
+        if capture_class is None:
+            capture_class = get_capture_class(
+                RequestQueryCountConfig.get_setting('CAPTURE')
+            )
+        captures = [
+            capture_class(connections[database], container.detail)
+            for database in databases
+        ]
+        captures_stack = cls.get_captures_stack()
+        if captures_stack:
+            for capture in captures_stack[-1]:
+                capture.pause()
+        for capture in captures:
+            capture.start()
+        captures_stack.append(captures)
+        return captures
+
+    @classmethod
+    def stop_captures(cls, captures=None):
+        """
+        Stops captures started by start_captures, resuming the enclosing ones
+        :param captures: the captures to stop. Defaults to the innermost ones
+        :return: list of (database alias, queries) tuples
+        """
+        captures_stack = cls.get_captures_stack()
+        if captures is None:
+            captures = captures_stack[-1]
+        # Concurrent async requests don't necessarily finish in order
+        index = next(index for index, started in enumerate(captures_stack)
+                     if started is captures)
+        del captures_stack[index]
+        result = [
+            (capture.connection.alias, capture.stop())
+            for capture in captures
+        ]
+        if captures_stack and index == len(captures_stack):
+            for capture in captures_stack[-1]:
+                capture.resume()
+        return result
 
     @classmethod
     def is_middleware_class(cls, middleware_path):
@@ -40,11 +175,7 @@ class RequestQueryCountManager(object):
     @classmethod
     def add_middleware(cls):
         middleware_class_name = 'test_query_counter.middleware.Middleware'
-        middleware_setting = getattr(settings, 'MIDDLEWARE', None)
-        setting_name = 'MIDDLEWARE'
-        if middleware_setting is None:
-            middleware_setting = settings.MIDDLEWARE_CLASSES
-            setting_name = 'MIDDLEWARE_CLASSES'
+        middleware_setting = settings.MIDDLEWARE
 
         # add the middleware only if it was not added before
         if not any(map(cls.is_middleware_class, middleware_setting)):
@@ -59,45 +190,123 @@ class RequestQueryCountManager(object):
                     (middleware_class_name,)
                 )
             else:
-                err_msg = "{} is missing from {}.".format(
-                    middleware_class_name,
-                    setting_name
+                err_msg = "{} is missing from MIDDLEWARE.".format(
+                    middleware_class_name
                 )
                 raise TypeError(err_msg)
 
-            setattr(settings, setting_name, new_middleware_setting)
+            settings.MIDDLEWARE = new_middleware_setting
+
+    @classmethod
+    def get_testcase_container_class(cls):
+        if RequestQueryCountConfig.detail_enabled():
+            return TestCaseQueryContainer
+        return TestCaseQueryCountContainer
 
     @classmethod
     def wrap_pre_set_up(cls, set_up):
         def wrapped(self, *args, **kwargs):
             result = set_up(self, *args, **kwargs)
             if RequestQueryCountConfig.enabled():
-                setattr(local, cls.LOCAL_TESTCASE_CONTAINER_NAME,
-                        TestCaseQueryContainer())
+                # Tests run by another test give the state of the outer test
+                # back when they finish
+                setattr(self, cls.OUTER_TESTCASE_STATE_NAME, {
+                    name: cls.get_local(name)
+                    for name in cls.LOCAL_TESTCASE_STATE_NAMES
+                })
+                container_class = cls.get_testcase_container_class()
+                container = container_class()
+                cls.set_local(cls.LOCAL_TESTCASE_CONTAINER_NAME, container)
+                cls.set_local(cls.LOCAL_CAPTURES_STACK_NAME, [])
+                cls.set_local(cls.LOCAL_TESTCASE_ID_NAME, self.id())
+                cls.set_local(cls.LOCAL_TESTCASE_BASELINE_NAME,
+                              cls.baseline and cls.baseline.get(self.id()))
+                cls.share_state({
+                    name: context_vars[name].get()
+                    for name in cls.SHARED_STATE_NAMES
+                })
+                if RequestQueryCountConfig.get_setting('CAPTURE_TEST_BODY'):
+                    # Wrap the test method itself, so the queries of the
+                    # fixtures and of setUp/tearDown are not counted
+                    method_name = self._testMethodName
+                    setattr(self, method_name, cls.wrap_test_method(
+                        getattr(self, method_name), container
+                    ))
             return result
 
         return wrapped
 
     @classmethod
-    def wrap_post_tear_down(cls, tear_down):
-        def wrapped(self, *args, **kwargs):
-            if (not hasattr(cls, 'queries') or not
-                    RequestQueryCountConfig.enabled()):
-                return tear_down(self, *args, **kwargs)
+    def wrap_test_method(cls, test_method, container):
+        @functools.wraps(test_method)
+        def wrapped(*args, **kwargs):
+            # A debug cursor capture would keep the queries log from being
+            # reset on each request for the whole test, so the requests would
+            # share its size limit
+            captures = cls.start_captures(
+                container, capture_class=ExecuteWrapperCapture
+            )
+            try:
+                return test_method(*args, **kwargs)
+            finally:
+                captured = cls.stop_captures(captures)
+                with cls.lock:
+                    for database, queries in captured:
+                        if not container.count(queries):
+                            continue
+                        container.add_by_key(
+                            (cls.TEST_BODY_METHOD, cls.TEST_BODY_PATH,
+                             database),
+                            queries
+                        )
 
-            container = cls.get_testcase_container()
+        return wrapped
 
-            test_method = getattr(self, self._testMethodName)
+    @classmethod
+    def get_exclusion_matcher(cls, test_case):
+        """
+        Returns the exclusions of a test method, compiled once and cached in
+        its test class
+        """
+        test_class = test_case.__class__
+        # Don't use the matchers inherited from the parent test class
+        matchers = vars(test_class).get(cls.EXCLUSION_MATCHERS_NAME)
+        if matchers is None:
+            matchers = {}
+            setattr(test_class, cls.EXCLUSION_MATCHERS_NAME, matchers)
 
+        matcher = matchers.get(test_case._testMethodName)
+        if matcher is None:
+            test_method = getattr(test_case, test_case._testMethodName)
             exclusions = (
-                getattr(self.__class__, "__querycount_exclude__", []) +
+                getattr(test_class, "__querycount_exclude__", []) +
                 getattr(test_method, "__querycount_exclude__", [])
             )
+            matcher = QueryCountExclusionMatcher(exclusions)
+            matchers[test_case._testMethodName] = matcher
+        return matcher
+
+    @classmethod
+    def wrap_post_tear_down(cls, tear_down):
+        def wrapped(self, *args, **kwargs):
+            if (cls.queries is None or not
+                    RequestQueryCountConfig.enabled()):
+                return tear_down(self, *args, **kwargs)
+
+            container = cls.get_testcase_container()
 
             all_queries = cls.queries
-            current_queries = container.filter_by(exclusions)
+            with cls.lock:
+                current_queries = container.filter_by(
+                    cls.get_exclusion_matcher(self)
+                )
             all_queries.add(self.id(), current_queries)
 
+            outer_state = vars(self).pop(cls.OUTER_TESTCASE_STATE_NAME, {})
+            for name, value in outer_state.items():
+                cls.set_local(name, value)
+            cls.share_state(outer_state)
+
             return tear_down(self, *args, **kwargs)
 
         return wrapped
@@ -112,59 +321,148 @@ class RequestQueryCountManager(object):
         )
 
     @classmethod
-    def save_json(cls, setting_name, container, detail):
+    def save_report(cls, setting_name, container, detail):
         summary_path = os.path.realpath(RequestQueryCountConfig.get_setting(
             setting_name))
         os.makedirs(os.path.dirname(summary_path), exist_ok=True)
 
-        with open(summary_path, 'w') as json_file:
-            json.dump(container.get_json(detail=detail), json_file,
-                      ensure_ascii=False, indent=4, sort_keys=True)
+        report_class = get_report_class(
+            RequestQueryCountConfig.get_setting('FORMAT')
+        )
+        if RequestQueryCountConfig.get_setting('MERGE'):
+            report_class.merge(summary_path, container, detail)
+        else:
+            report_class.save(summary_path, container, detail)
 
     @classmethod
-    def wrap_setup_test_environment(cls, func):
-        def wrapped(self, *args, **kwargs):
-            result = func(self, *args, **kwargs)
-            if not RequestQueryCountConfig.enabled():
-                return result
-            cls.queries = TestResultQueryContainer()
-            return result
+    def load_baseline(cls):
+        """
+        Returns the maximum number of queries of each API call by test case
+        id, allowed by the BASELINE_PATH report and the BASELINE_THRESHOLD
+        percentage, or None if there is no baseline
+        """
+        baseline_path = RequestQueryCountConfig.get_setting('BASELINE_PATH')
+        if baseline_path is None or not os.path.exists(baseline_path):
+            return None
 
-        return wrapped
+        threshold = RequestQueryCountConfig.get_setting('BASELINE_THRESHOLD')
+        max_factor = (threshold / 100.0 + 1)
+        with open_report(baseline_path, stream=True) as report:
+            return {
+                test_case['id']: {
+                    QueryCountEvaluator.api_call_key(element):
+                        round(element['total'] * max_factor)
+                    for element in test_case['queries']
+                }
+                for test_case in report.iter_test_cases()
+            }
 
     @classmethod
-    def wrap_teardown_test_environment(cls, func):
-        def wrapped(self, *args, **kwargs):
-            result = func(self, *args, **kwargs)
-            if not RequestQueryCountConfig.enabled():
-                return result
-            cls.save_json('SUMMARY_PATH', cls.queries, False)
-            cls.save_json('DETAIL_PATH', cls.queries, True)
-            cls.queries = None
-            return result
+    def check_baseline(cls, container, api_call_key):
+        """
+        Fails the running test if the queries of an API call exceed the ones
+        allowed by the baseline
+        :param container: TestCaseQueryContainer of the running test
+        :param api_call_key: tuple (method, path, database)
+        """
+        baseline = cls.get_local(cls.LOCAL_TESTCASE_BASELINE_NAME)
+        threshold = baseline and baseline.get(api_call_key)
+        if threshold is None:
+            return
 
-        return wrapped
+        queries = container.queries_by_api_method.get(api_call_key)
+        if queries is None:
+            return
+
+        total = container.count(queries)
+        if total > threshold:
+            method, path, database = api_call_key
+            test_case_id = cls.get_local(cls.LOCAL_TESTCASE_ID_NAME)
+            raise AssertionError(Violation(
+                test_case_id, method, path, threshold, total, database
+            ).get_message())
 
     @classmethod
-    def patch_runner(cls):
-        # FIXME: this is incompatible with --parallel and --test-runner
-        # command arguments
-        test_runner = get_runner(settings)
+    def start_test_run(cls):
+        """
+        Starts collecting the queries of a test run, called after
+        django.test.utils.setup_test_environment
+        """
+        cls.set_up()
+        cls.queries = TestResultQueryContainer()
+        cls.baseline = cls.load_baseline()
 
-        if (not hasattr(test_runner, 'setup_test_environment') or not
-                hasattr(test_runner, 'teardown_test_environment')):
+    @classmethod
+    def finish_test_run(cls):
+        """
+        Saves the count files of the test run, called after
+        django.test.utils.teardown_test_environment
+        """
+        if cls.queries is None:
             return
+        cls.save_report('SUMMARY_PATH', cls.queries, False)
+        if RequestQueryCountConfig.detail_enabled():
+            cls.save_report('DETAIL_PATH', cls.queries, True)
+        cls.queries = None
+        cls.baseline = None
 
-        test_runner.setup_test_environment = cls.wrap_setup_test_environment(
-            test_runner.setup_test_environment
-        )
-        test_runner.teardown_test_environment = \
-            cls.wrap_teardown_test_environment(
-                test_runner.teardown_test_environment
-            )
+    @classmethod
+    def add_remote_queries(cls, test, queries):
+        """
+        Handler for the query count events sent by the --parallel workers
+        :param test: the test case the queries belong to
+        :param queries: TestCaseQueryContainer recorded by the worker
+        """
+        if cls.queries is not None:
+            cls.queries.add(test.id(), queries)
+
+    @classmethod
+    def wrap_call(cls, call):
+        def wrapped(self, result=None, *args, **kwargs):
+            is_remote = isinstance(result, RemoteTestResult)
+            # spawned workers never run setup_test_environment
+            if (is_remote and cls.queries is None and
+                    RequestQueryCountConfig.enabled()):
+                cls.queries = TestResultQueryContainer()
+
+            call_result = call(self, result, *args, **kwargs)
+
+            # Ship the queries of the test case back to the parent process
+            # along with the rest of the pickled events
+            if is_remote and cls.queries is not None:
+                queries = cls.queries.pop(self.id())
+                if queries is not None:
+                    result.events.append(
+                        (cls.PARALLEL_EVENT_NAME, result.test_index, queries)
+                    )
+            return call_result
+
+        return wrapped
+
+    @classmethod
+    def wrap_parallel_run(cls, run):
+        def wrapped(self, result, *args, **kwargs):
+            # ParallelTestSuite dispatches every event to the result method
+            # of the same name, and skips the ones it doesn't know about
+            setattr(result, cls.PARALLEL_EVENT_NAME, cls.add_remote_queries)
+            return run(self, result, *args, **kwargs)
+
+        return wrapped
+
+    @classmethod
+    def patch_parallel_runner(cls):
+        SimpleTestCase.__call__ = cls.wrap_call(SimpleTestCase.__call__)
+        ParallelTestSuite.run = cls.wrap_parallel_run(ParallelTestSuite.run)
 
     @classmethod
     def set_up(cls):
+        """
+        Adds the middleware and patches the test cases, only once per process
+        """
+        if cls.is_set_up:
+            return
+        cls.is_set_up = True
+        RequestQueryCountConfig.get_exclusion_matcher()
         cls.add_middleware()
         cls.patch_test_case()
-        cls.patch_runner()
+        cls.patch_parallel_runner()
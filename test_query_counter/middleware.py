@@ -1,14 +1,10 @@
 from django.core.exceptions import MiddlewareNotUsed
-from django.core.signals import request_started
-from django.db import DEFAULT_DB_ALIAS, connections, reset_queries
+from django.utils.deprecation import MiddlewareMixin
 from test_query_counter.apps import RequestQueryCountConfig
+from test_query_counter.capture import get_capture_class
 from test_query_counter.manager import RequestQueryCountManager
-
-try:
-    from django.utils.deprecation import MiddlewareMixin
-except ImportError:  # Django < 1.10
-    # Works perfectly for everyone using MIDDLEWARE_CLASSES
-    MiddlewareMixin = object
+from test_query_counter.request_keys import (get_request_key,
+                                             import_request_key)
 
 
 class Middleware(MiddlewareMixin):
@@ -19,37 +15,71 @@ class Middleware(MiddlewareMixin):
     The middleware is intended to be automatically added
 
     If the query container is None, then the middleware is not executed.
+
+    Under ASGI, MiddlewareMixin runs the process_request and process_response
+    hooks in the thread of the database connections used by sync_to_async,
+    so their queries are captured, and the container is looked up through
+    context variables, that follow the test into that thread.
     """
 
+    # The container and the captures are stored in the request, as
+    # concurrent async requests share the middleware, and the test can finish
+    # before a live server request does
+    CAPTURES_ATTRIBUTE = '_querycount_captures'
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         if not RequestQueryCountConfig.enabled():
             raise MiddlewareNotUsed()
-        self.force_debug_cursor = False
-        self.initial_queries = 0
-        self.final_queries = None
-        self.connection = connections[DEFAULT_DB_ALIAS]
-
-    def process_request(self, _):
-        if RequestQueryCountManager.get_testcase_container():
-            # Took from django.test.utils.CaptureQueriesContext
-            self.force_debug_cursor = self.connection.force_debug_cursor
-            self.connection.force_debug_cursor = True
-            self.initial_queries = len(self.connection.queries_log)
-            self.final_queries = None
-            request_started.disconnect(reset_queries)
+        # Fail on start up rather than on the first request
+        get_capture_class(RequestQueryCountConfig.get_setting('CAPTURE'))
+        request_key = RequestQueryCountConfig.get_setting('REQUEST_KEY')
+        if request_key is None:
+            self.request_key = get_request_key(
+                RequestQueryCountConfig.get_setting('KEY_BY')
+            )
+        else:
+            self.request_key = import_request_key(request_key)
+        self.databases = RequestQueryCountConfig.get_databases()
+
+    def process_request(self, request):
+        query_container = RequestQueryCountManager.get_testcase_container()
+        if query_container:
+            exclusion_matcher = RequestQueryCountConfig.get_exclusion_matcher()
+            # Excluded requests are not captured, but they still pause the
+            # enclosing captures, e.g. the test body ones
+            databases = (
+                [] if exclusion_matcher.matches(request.method, request.path)
+                else self.databases
+            )
+            captures = RequestQueryCountManager.start_captures(
+                query_container, databases
+            )
+            setattr(request, self.CAPTURES_ATTRIBUTE,
+                    (query_container, captures))
 
     def process_response(self, request, response):
-        if RequestQueryCountManager.get_testcase_container():
-            # Took from django.test.utils.CaptureQueriesContext
-            self.connection.force_debug_cursor = self.force_debug_cursor
-            request_started.connect(reset_queries)
-            final_queries = len(self.connection.queries_log)
-            captured_queries = self.connection.queries[
-                self.initial_queries:final_queries
-            ]
-
-            query_container = RequestQueryCountManager.get_testcase_container()
-            query_container.add(request, captured_queries)
+        started = getattr(request, self.CAPTURES_ATTRIBUTE, None)
+        if started is not None:
+            delattr(request, self.CAPTURES_ATTRIBUTE)
+            query_container, captures = started
+            captured = RequestQueryCountManager.stop_captures(captures)
+
+            api_call = self.request_key(request)
+            if isinstance(api_call, str):
+                api_call = (request.method, api_call)
+            method, path = api_call
+            with RequestQueryCountManager.lock:
+                for database, queries in captured:
+                    query_container.add(request, queries, database,
+                                        (method, path))
+            # The baseline is the one of the running test
+            if (query_container is not
+                    RequestQueryCountManager.get_testcase_container()):
+                return response
+            for database, _ in captured:
+                RequestQueryCountManager.check_baseline(
+                    query_container, (method, path, database)
+                )
 
         return response
@@ -1,10 +1,40 @@
 import json
+import math
 import re
 import sys
+from collections import Counter
+from functools import lru_cache, wraps
 from sys import maxsize, stderr
 
+from django.db import DEFAULT_DB_ALIAS
+from test_query_counter.reports import JSONReport, dump_test_cases
+
 ANY = ''
 
+# Method of the API calls recorded by count_queries
+COUNT_QUERIES_METHOD = 'BLOCK'
+
+FINGERPRINT_SUBSTITUTIONS = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%s'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),
+    (re.compile(r'\s+'), ' '),
+)
+
+
+@lru_cache(maxsize=4096)
+def fingerprint(sql):
+    """
+    Returns the shape of a SQL query, replacing its literals and params by
+    placeholders, so that queries that only differ on them are equal.
+
+    :param sql: SQL of the query
+    """
+    for pattern, replacement in FINGERPRINT_SUBSTITUTIONS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
 
 class QueryCountExclusion(object):
     """Represents an test condition to exclude some of the query counts made
@@ -15,17 +45,137 @@ class QueryCountExclusion(object):
         self.method = re.compile(method, re.IGNORECASE)
         self.count = count
 
-    def is_excluded(self, method, path, queries):
+    def is_excluded(self, method, path, num_queries):
         """
         Compare method path <num queries> against the exclusion
 
         :param method: method to compare against
         :param path: path to compare
-        :param queries: number of queries made to that particular request
+        :param num_queries: number of queries made to that particular request
         :return: True if this exclusion applies to the request
         """
         return self.method.search(method) and self.path.search(path) \
-            and len(queries) <= self.count
+            and num_queries <= self.count
+
+
+class QueryCountExclusionMatcher(object):
+    """
+    Matches requests against a list of exclusions at once. Exclusions are
+    bucketed by the request methods they apply to, and the paths of each
+    bucket are combined in a single regex ordered by count, so one search
+    finds the most tolerant exclusion for a request. Results are memoized by
+    method and path.
+    """
+
+    def __init__(self, exclusion_list):
+        self.exclusion_list = list(exclusion_list)
+        self.patterns_by_method = {}
+        self.counts_by_request = {}
+
+    @classmethod
+    def compile(cls, exclusions):
+        """
+        Combines the paths of the exclusions in a single regex, with a group
+        named after the position of each exclusion
+        :param exclusions: list of exclusions, most tolerant first
+        :return: the compiled regex, or None if the paths can't be combined
+        """
+        # Combining the paths renumbers their groups, so the numbered back
+        # references would point at the groups of other exclusions
+        if any(exclusion.path.groups for exclusion in exclusions):
+            return None
+        alternatives = (
+            r'(?=[\s\S]*?(?:{}))(?P<exclusion_{}>)'.format(
+                exclusion.path.pattern, index
+            )
+            for index, exclusion in enumerate(exclusions)
+        )
+        try:
+            return re.compile('|'.join(alternatives), re.IGNORECASE)
+        except re.error:
+            # e.g. paths with inline global flags
+            return None
+
+    def get_pattern(self, method):
+        pattern = self.patterns_by_method.get(method)
+        if pattern is None:
+            exclusions = sorted(
+                (exclusion for exclusion in self.exclusion_list
+                 if exclusion.method.search(method)),
+                key=lambda exclusion: exclusion.count,
+                reverse=True
+            )
+            regex = self.compile(exclusions) if exclusions else None
+            pattern = (exclusions, regex)
+            self.patterns_by_method[method] = pattern
+        return pattern
+
+    def get_count(self, method, path):
+        """
+        Returns the maximum number of queries excluded for a request, or None
+        if no exclusion applies to it
+        """
+        key = (method, path)
+        if key not in self.counts_by_request:
+            exclusions, regex = self.get_pattern(method)
+            count = None
+            if regex is not None:
+                match = regex.match(path)
+                if match:
+                    index = int(match.lastgroup[len('exclusion_'):])
+                    count = exclusions[index].count
+            else:
+                count = next((exclusion.count for exclusion in exclusions
+                              if exclusion.path.search(path)), None)
+            self.counts_by_request[key] = count
+        return self.counts_by_request[key]
+
+    def matches(self, method, path):
+        """Returns True if any exclusion applies to a request"""
+        return self.get_count(method, path) is not None
+
+    def is_excluded(self, method, path, num_queries):
+        """
+        Compare method path <num queries> against all the exclusions
+
+        :param method: method to compare against
+        :param path: path to compare
+        :param num_queries: number of queries made to that particular request
+        :return: True if any exclusion applies to the request
+        """
+        count = self.get_count(method, path)
+        return count is not None and num_queries <= count
+
+
+class QueryCountBudget(object):
+    """
+    Hard maximum number of queries of the API calls that match a path and a
+    method regex, regardless of the previous runs
+    """
+
+    def __init__(self, path=ANY, method=ANY, count=sys.maxsize):
+        """
+        :param path: the regex of the path(s) of the API calls
+        :param method: the regex of the method(s) of the API calls
+        :param count: maximum number of queries allowed
+        """
+        self.path = re.compile(path, re.IGNORECASE)
+        self.method = re.compile(method, re.IGNORECASE)
+        self.count = count
+
+    def applies(self, method, path):
+        return bool(self.method.search(method) and self.path.search(path))
+
+    @classmethod
+    def load(cls, stream):
+        """
+        Loads the budgets of a JSON stream, which contains a list of objects
+        with a 'count', and optionally 'path' and 'method' regexes
+        """
+        return [
+            cls(rule.get('path', ANY), rule.get('method', ANY), rule['count'])
+            for rule in json.load(stream)
+        ]
 
 
 def exclude_query_count(path=ANY, method=ANY, count=sys.maxsize):
@@ -47,6 +197,55 @@ def exclude_query_count(path=ANY, method=ANY, count=sys.maxsize):
     return decorator
 
 
+class count_queries(object):
+    """
+    Counts the queries made by a block of code during a test, under its own
+    label. They are reported and compared like the queries of an API call,
+    with the COUNT_QUERIES_METHOD method and the label as path. Can be used as
+    a context manager or as a decorator. Outside of a test, queries are not
+    counted.
+
+    :param label: name the queries are recorded under
+    """
+
+    def __init__(self, label):
+        self.label = label
+        # Containers and captures of the blocks being counted, innermost
+        # last, so the same instance can be entered again in the block
+        self.containers = []
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            # Each call gets its own instance, as the calls can be
+            # concurrent, e.g. in the live server threads
+            with self.__class__(self.label):
+                return func(*args, **kwargs)
+
+        return wrapped
+
+    def __enter__(self):
+        from test_query_counter.manager import RequestQueryCountManager
+        container = RequestQueryCountManager.get_testcase_container()
+        captures = None
+        if container is not None:
+            captures = RequestQueryCountManager.start_captures(container)
+        self.containers.append((container, captures))
+        return self
+
+    def __exit__(self, *exc_info):
+        from test_query_counter.manager import RequestQueryCountManager
+        container, captures = self.containers.pop()
+        if container is not None:
+            captured = RequestQueryCountManager.stop_captures(captures)
+            with RequestQueryCountManager.lock:
+                for database, queries in captured:
+                    container.add_by_key(
+                        (COUNT_QUERIES_METHOD, self.label, database), queries
+                    )
+        return False
+
+
 class TestResultQueryContainer(object):
     """Stores all the queries from a Test Run, aggregated by Test Case"""
 
@@ -63,11 +262,23 @@ class TestResultQueryContainer(object):
         """
         existing_query_container = self.queries_by_testcase.get(
             test_case_id,
-            TestCaseQueryContainer()
+            queries.__class__()
         )
         existing_query_container.merge(queries)
         self.queries_by_testcase[test_case_id] = existing_query_container
-        self.total += existing_query_container.total
+        self.total += queries.total
+
+    def pop(self, test_case_id):
+        """
+        Removes the queries from a test case
+        :param test_case_id: identifier for test case
+        :return: the TestCaseQueryContainer removed, or None if there were no
+            queries for the test case
+        """
+        query_container = self.queries_by_testcase.pop(test_case_id, None)
+        if query_container is not None:
+            self.total -= query_container.total
+        return query_container
 
     @classmethod
     def test_case_json(cls, test_case_id, query_container, detail):
@@ -85,38 +296,115 @@ class TestResultQueryContainer(object):
         """
         return {
             'total': self.total,
-            'test_cases': [
-                self.test_case_json(test_case_id, queries, detail)
-                for test_case_id, queries in self.queries_by_testcase.items()
-            ]
+            'test_cases': list(self.iter_test_cases_json(detail))
         }
 
+    def iter_test_cases_json(self, detail):
+        """Yields the JSON compatible representation of each test case"""
+        for test_case_id, queries in self.queries_by_testcase.items():
+            yield self.test_case_json(test_case_id, queries, detail)
+
+    def dump(self, stream, detail):
+        """
+        Writes the JSON representation of the Test Result into a stream. The
+        output is the same as json.dump(self.get_json(detail), indent=4,
+        sort_keys=True), but test cases are encoded one at a time, so the
+        whole representation is never held in memory.
+
+        :param stream: text stream to write into
+        :param detail: If True, will include query details
+        """
+        dump_test_cases(stream, self.iter_test_cases_json(detail),
+                        self.total)
+
 
 class TestCaseQueryContainer(object):
     """Stores queries by API method for a particular test case"""
+
+    # Whether the container retains the queries, or only counts them
+    detail = True
+
     def __init__(self, queries_by_api_method=None):
         self.recorded_requests = set()
         self.queries_by_api_method = queries_by_api_method or dict()
-        self.total = len(self.queries_by_api_method)
+        self.total = sum(
+            self.count(queries)
+            for queries in self.queries_by_api_method.values()
+        )
+
+    def __getstate__(self):
+        # Requests are not picklable, and only matter while the test runs
+        state = self.__dict__.copy()
+        state['recorded_requests'] = set()
+        return state
 
     def add_by_key(self, api_method_key, queries):
         """
         Appends queries to a certain api method
-        :param api_method_key: tuple (method, path)
+        :param api_method_key: tuple (method, path, database)
         :param queries: list of queries
         """
-        existing_queries = self.queries_by_api_method.get(api_method_key, [])
-        self.queries_by_api_method[api_method_key] = queries + existing_queries
+        if self.is_empty_entry(api_method_key, queries):
+            return
+        existing_queries = self.queries_by_api_method.get(api_method_key)
+        if existing_queries is None:
+            existing_queries = self.queries_by_api_method[api_method_key] = []
+        existing_queries.extend(queries)
         self.total += len(queries)
 
-    def add(self, request, queries):
-        """Agregates the queries to the captured queries dict"""
-        if request in self.recorded_requests:
+    @classmethod
+    def from_json(cls, test_case, detail):
+        """
+        Returns a container with the queries of the JSON representation of a
+        test case
+        :param test_case: JSON representation of the test case
+        :param detail: If True, the queries of each API call are kept, which
+            requires a detail representation. Otherwise, they are only counted
+        """
+        container_class = (TestCaseQueryContainer if detail
+                           else TestCaseQueryCountContainer)
+        queries_by_api_method = {}
+        for element in test_case['queries']:
+            key = (element['method'], element['path'],
+                   element.get('database', DEFAULT_DB_ALIAS))
+            queries_by_api_method[key] = (element['queries'] if detail
+                                          else element['total'])
+        return container_class(queries_by_api_method)
+
+    @classmethod
+    def count(cls, queries):
+        """Returns the number of queries stored for an api method"""
+        return len(queries)
+
+    @classmethod
+    def is_empty_entry(cls, api_method_key, queries):
+        """
+        Returns whether there are no queries to record for an api method on a
+        database other than the default one. Requests without queries are
+        only recorded on the default database, so the reports don't grow with
+        the number of databases.
+        :param api_method_key: tuple (method, path, database)
+        :param queries: queries of the api method
+        """
+        return (api_method_key[2] != DEFAULT_DB_ALIAS and
+                not cls.count(queries))
+
+    def add(self, request, queries, database=DEFAULT_DB_ALIAS,
+            api_call=None):
+        """
+        Agregates the queries to the captured queries dict
+        :param request: the request that made the queries
+        :param queries: queries made by the request
+        :param database: alias of the database the queries were made on
+        :param api_call: tuple (method, path) the queries are recorded under.
+            Defaults to the method and path of the request
+        """
+        if (request, database) in self.recorded_requests:
             return
 
-        self.recorded_requests.add(request)
-        key = (request.method, request.path)
-        self.add_by_key(key, queries)
+        self.recorded_requests.add((request, database))
+        method, path = api_call or (request.method, request.path)
+        self.add_by_key((method, path, database), queries)
 
     def merge(self, test_case_container):
         """
@@ -129,36 +417,83 @@ class TestCaseQueryContainer(object):
     @classmethod
     def excluded(cls, method, path, queries, exclusion_list):
         return any((
-            exclusion.is_excluded(method, path, queries)
+            exclusion.is_excluded(method, path, cls.count(queries))
             for exclusion in exclusion_list
         ))
 
-    def filter_by(self, exclusion_list):
-        return TestCaseQueryContainer({
-            (method, path): queries
-            for (method, path), queries in self.queries_by_api_method.items()
-            if not self.excluded(method, path, queries, exclusion_list)
+    def filter_by(self, exclusions):
+        """
+        Returns a container without the queries of the excluded api methods
+        :param exclusions: a QueryCountExclusionMatcher, or a list of
+            QueryCountExclusion
+        """
+        if not isinstance(exclusions, QueryCountExclusionMatcher):
+            exclusions = QueryCountExclusionMatcher(exclusions)
+        return self.__class__({
+            (method, path, database): queries
+            for (method, path, database), queries
+            in self.queries_by_api_method.items()
+            if not exclusions.is_excluded(method, path, self.count(queries))
         })
 
     @classmethod
     def api_call_json(cls, api_call, queries, detail):
         """
         Returns a json representation of a single API Call
-        :param api_call: API call tuple (method, path)
+        :param api_call: API call tuple (method, path, database)
         :param queries: list of queries
         :param detail: if True, the list of queries is returned
         :return: Dictionary
         """
-        method, path = api_call
+        method, path, database = api_call
         result = {
             'method': method,
             'path': path,
-            'total': len(queries),
+            'database': database,
+            'total': cls.count(queries),
         }
-        if detail:
+        if cls.detail:
+            result['time'] = cls.time_json(queries)
+            result['duplicates'] = cls.duplicates_json(queries)
+        if detail and cls.detail:
             result['queries'] = queries
         return result
 
+    @classmethod
+    def duplicates_json(cls, queries):
+        """
+        Returns the query shapes repeated in a list of queries, which are
+        usually caused by N+1 problems
+        :param queries: list of queries
+        :return: list of dictionaries with the shape and its number of
+            repetitions, most repeated first
+        """
+        # The shapes are not kept with the queries, as they would double
+        # the SQL held in memory and written in the detail file
+        shapes = Counter(fingerprint(query['sql']) for query in queries)
+        return [
+            {'sql': shape, 'count': count}
+            for shape, count in shapes.most_common()
+            if count > 1
+        ]
+
+    @classmethod
+    def time_json(cls, queries):
+        """
+        Returns the aggregated time of a list of queries, in seconds
+        :param queries: list of queries
+        :return: Dictionary with the total, max and 95th percentile times
+        """
+        times = sorted(float(query['time']) for query in queries)
+        if not times:
+            return {'total': 0, 'max': 0, 'p95': 0}
+        p95_index = max(math.ceil(len(times) * 0.95) - 1, 0)
+        return {
+            'total': round(sum(times), 3),
+            'max': times[-1],
+            'p95': times[p95_index],
+        }
+
     def get_json(self, detail):
         """Returns a JSON representation of the object"""
         return {
@@ -170,31 +505,131 @@ class TestCaseQueryContainer(object):
         }
 
 
+class TestCaseQueryCountContainer(TestCaseQueryContainer):
+    """
+    Stores the number of queries by API method for a particular test case,
+    without retaining the queries themselves
+    """
+
+    detail = False
+
+    def add_by_key(self, api_method_key, queries):
+        """
+        Adds queries to the count of a certain api method
+        :param api_method_key: tuple (method, path, database)
+        :param queries: number of queries
+        """
+        if self.is_empty_entry(api_method_key, queries):
+            return
+        existing_queries = self.queries_by_api_method.get(api_method_key, 0)
+        self.queries_by_api_method[api_method_key] = queries + existing_queries
+        self.total += queries
+
+    @classmethod
+    def count(cls, queries):
+        return queries
+
+
 class Violation(object):
 
-    def __init__(self, test_case_id, method, path, threshold, total):
+    def __init__(self, test_case_id, method, path, threshold, total,
+                 database=DEFAULT_DB_ALIAS):
         self.test_case_id = test_case_id
         self.method = method
         self.path = path
+        self.database = database
         self.threshold = threshold
         self.total = total
 
+    def get_api_call(self):
+        api_call = '{} {}'.format(self.method, self.path)
+        if self.database != DEFAULT_DB_ALIAS:
+            api_call += ' on database {}'.format(self.database)
+        return api_call
+
+    def get_message(self):
+        return 'In test case {}, {}. Expected at most {} queries but got ' \
+               '{} queries'.format(self.test_case_id, self.get_api_call(),
+                                   self.threshold, self.total)
+
+
+class TimeViolation(Violation):
+    """Violation of the total time (in seconds) of an API call queries"""
+
+    def get_message(self):
+        return 'In test case {}, {}. Expected at most {:.3f}s of queries ' \
+               'but got {:.3f}s'.format(self.test_case_id,
+                                        self.get_api_call(), self.threshold,
+                                        self.total)
+
+
+class DuplicateViolation(Violation):
+    """Violation of the number of repetitions of a query shape"""
+
+    def __init__(self, test_case_id, method, path, threshold, total,
+                 database=DEFAULT_DB_ALIAS, sql=None):
+        super().__init__(test_case_id, method, path, threshold, total,
+                         database)
+        self.sql = sql
+
+    def get_message(self):
+        return 'In test case {}, {}. Expected at most {} repeated queries ' \
+               'but got {} queries of shape {}'.format(
+                   self.test_case_id, self.get_api_call(), self.threshold,
+                   self.total, self.sql)
+
+
+class BudgetViolation(Violation):
+    """Violation of the absolute budget of an API call"""
+
+    def get_message(self):
+        return 'In test case {}, {}. Expected at most {} queries by budget ' \
+               'but got {} queries'.format(self.test_case_id,
+                                           self.get_api_call(),
+                                           self.threshold, self.total)
+
 
 class QueryCountEvaluator(object):
 
-    def __init__(self, threshold, current_file, last_file, stream=stderr):
+    # Minimum increase of the total query time of an API call, in seconds,
+    # for it to be a violation. Query times are logged to the millisecond, so
+    # without it an API call that took 0.000s fails when it takes 0.001s.
+    MIN_TIME_INCREASE = 0.05
+
+    def __init__(self, threshold, current_file, last_file, stream=stderr,
+                 time_threshold=None, duplicate_threshold=None,
+                 budgets=None):
         """
         Initializes the Evaluator, which writes t
         :param threshold: Threshold in percentage (e.g. 10)
-        :param current_file: stream with the about-to-commit API Calls result
-        :param last_file: stream with the last "accepted" API calls to compare
+        :param current_file: stream with the about-to-commit API Calls result,
+            or a report opened with test_query_counter.reports.open_report
+        :param last_file: stream with the last "accepted" API calls to
+            compare, or a report opened with open_report
         :param stream: steam to write into (default: stderr)
+        :param time_threshold: Threshold of the total query time in
+            percentage. If None, query times are not compared.
+        :param duplicate_threshold: Maximum number of queries of the same
+            shape in an API call. If None, repeated queries are not checked.
+        :param budgets: list of QueryCountBudget. The first one that applies
+            to an API call sets its maximum number of queries, even if it is
+            new since the last run.
         """
         self.threshold = threshold
-        self.current = json.load(current_file)
-        self.last = json.load(last_file)
+        self.time_threshold = time_threshold
+        self.duplicate_threshold = duplicate_threshold
+        self.budgets = budgets or []
+        self.budgets_by_api_call = {}
+        self.current = self.get_report(current_file)
+        self.last = self.get_report(last_file)
         self.stream = stream
 
+    @classmethod
+    def get_report(cls, report):
+        if hasattr(report, 'iter_test_cases'):
+            return report
+        return JSONReport.load(report)
+
     @classmethod
     def default_test_case_element(cls, test_case_id):
         return {
@@ -204,15 +639,10 @@ class QueryCountEvaluator(object):
         }
 
     def list_violations(self):
-        last_test_cases = {
-            test_case['id']: test_case
-            for test_case in self.last['test_cases']
-        }
-
-        for element in self.current['test_cases']:
+        for element in self.current.iter_test_cases():
             test_case_id = element['id']
-            last_test_cases_queries = last_test_cases.get(
-                test_case_id,
+            last_test_cases_queries = (
+                self.last.get_test_case(test_case_id) or
                 self.default_test_case_element(test_case_id)
             )
             for violation in self.compare_test_cases(
@@ -228,26 +658,52 @@ class QueryCountEvaluator(object):
         and the last run.
         :return: a list of the violations ocurred
         """
-        violations = list(self.list_violations())
-        if any(violations):
-            self.stream.write('There are test cases with API '
-                              'calls that exceeded threshold:\n\n')
-
-        for violation in violations:
-            msg = '\tIn test case {}, {} {}. Expected at most {} queries but' \
-                  ' got {} queries' \
-                  '\n'.format(violation.test_case_id, violation.method,
-                              violation.path, violation.threshold,
-                              violation.total)
-            self.stream.write(msg)
+        return list(self.iter_run())
 
-        if not any(violations):
+    def iter_run(self):
+        """
+        Same as run, but each violation is printed and yielded as soon as it
+        is found, so violations are never held in memory.
+        """
+        any_violations = False
+        for violation in self.list_violations():
+            if not any_violations:
+                self.stream.write('There are test cases with API '
+                                  'calls that exceeded threshold:\n\n')
+                any_violations = True
+            self.stream.write('\t{}\n'.format(violation.get_message()))
+            self.stream.flush()
+            yield violation
+
+        if not any_violations:
             self.stream.write('All Tests API Queries are below the allowed '
                               'threshold.\n')
 
         self.stream.flush()
 
-        return violations
+    def get_budget(self, method, path):
+        """
+        Returns the maximum number of queries of an API call, or None if no
+        budget applies to it
+        """
+        key = (method, path)
+        if key not in self.budgets_by_api_call:
+            self.budgets_by_api_call[key] = next(
+                (budget.count for budget in self.budgets
+                 if budget.applies(method, path)),
+                None
+            )
+        return self.budgets_by_api_call[key]
+
+    @classmethod
+    def get_database(cls, query_element):
+        # Reports made before multiple database support are all on default
+        return query_element.get('database', DEFAULT_DB_ALIAS)
+
+    @classmethod
+    def api_call_key(cls, query_element):
+        return (query_element['method'], query_element['path'],
+                cls.get_database(query_element))
 
     def compare_test_cases(self, test_case_id, current_queries, last_queries):
         """
@@ -260,13 +716,14 @@ class QueryCountEvaluator(object):
             threshold
         """
         last_queries_dict = {
-            (element['method'], element['path']): element['total']
+            self.api_call_key(element): element
             for element in last_queries
         }
 
         def get_last_queries(query_element):
-            key = (query_element['method'], query_element['path'])
-            return last_queries_dict.get(key, maxsize)
+            key = self.api_call_key(query_element)
+            last_element = last_queries_dict.get(key)
+            return maxsize if last_element is None else last_element['total']
 
         def get_threshold(query_element):
             max_factor = (self.threshold / 100.0 + 1)
@@ -275,7 +732,46 @@ class QueryCountEvaluator(object):
         def violates_threshold(query_element):
             return query_element['total'] > get_threshold(query_element)
 
-        return (Violation(test_case_id, element['method'], element['path'],
-                          get_threshold(element), element['total'])
-                for element in current_queries
-                if violates_threshold(element))
+        def get_time_threshold(query_element):
+            last_element = last_queries_dict.get(
+                self.api_call_key(query_element), {}
+            )
+            if 'time' not in last_element:
+                return None
+            max_factor = (self.time_threshold / 100.0 + 1)
+            last_time = last_element['time']['total']
+            return max(last_time * max_factor,
+                       last_time + self.MIN_TIME_INCREASE)
+
+        def violates_time_threshold(query_element):
+            if self.time_threshold is None or 'time' not in query_element:
+                return False
+            time_threshold = get_time_threshold(query_element)
+            return (time_threshold is not None and
+                    query_element['time']['total'] > time_threshold)
+
+        for element in current_queries:
+            if violates_threshold(element):
+                yield Violation(test_case_id, element['method'],
+                                element['path'], get_threshold(element),
+                                element['total'], self.get_database(element))
+            if violates_time_threshold(element):
+                yield TimeViolation(test_case_id, element['method'],
+                                    element['path'],
+                                    get_time_threshold(element),
+                                    element['time']['total'],
+                                    self.get_database(element))
+            budget = self.get_budget(element['method'], element['path'])
+            if budget is not None and element['total'] > budget:
+                yield BudgetViolation(test_case_id, element['method'],
+                                      element['path'], budget,
+                                      element['total'],
+                                      self.get_database(element))
+            if self.duplicate_threshold is not None:
+                for duplicate in element.get('duplicates', []):
+                    if duplicate['count'] > self.duplicate_threshold:
+                        yield DuplicateViolation(
+                            test_case_id, element['method'], element['path'],
+                            self.duplicate_threshold, duplicate['count'],
+                            self.get_database(element), duplicate['sql']
+                        )
@@ -0,0 +1,497 @@
+import codecs
+import json
+import os
+import re
+import sqlite3
+import textwrap
+
+from django.core.exceptions import ImproperlyConfigured
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+WHITESPACE = re.compile(r'\s*')
+
+
+def dump_test_cases(stream, test_cases, total=None):
+    """
+    Writes a JSON report into a stream. The output is the same as
+    json.dump({'test_cases': test_cases, 'total': total}, indent=4,
+    sort_keys=True), but test cases are encoded one at a time, so they are
+    never held in memory.
+
+    :param stream: text stream to write into
+    :param test_cases: iterable of the JSON representation of test cases
+    :param total: total number of queries. Defaults to the sum of the test
+        cases totals
+    """
+    test_cases_total = 0
+    stream.write('{\n    "test_cases": [')
+    separator = '\n'
+    for test_case in test_cases:
+        encoded = json.dumps(test_case, ensure_ascii=False, indent=4,
+                             sort_keys=True)
+        stream.write(separator)
+        stream.write(textwrap.indent(encoded, ' ' * 8))
+        separator = ',\n'
+        test_cases_total += test_case['total']
+    if separator != '\n':
+        stream.write('\n    ')
+    if total is None:
+        total = test_cases_total
+    stream.write('],\n    "total": {}\n}}'.format(total))
+
+
+def iter_merged_test_cases(report, container, detail):
+    """
+    Yields the JSON representation of the test cases of a report, replaced by
+    the ones of a Test Result that includes them, followed by the rest of the
+    test cases of the Test Result
+    :param report: report opened with open_report
+    :param container: TestResultQueryContainer to merge
+    :param detail: If True, will include query details
+    """
+    merged_ids = set()
+    for test_case in report.iter_test_cases():
+        test_case_id = test_case['id']
+        queries = container.queries_by_testcase.get(test_case_id)
+        if queries is not None:
+            merged_ids.add(test_case_id)
+            test_case = container.test_case_json(test_case_id, queries,
+                                                 detail)
+        yield test_case
+
+    for test_case_id, queries in container.queries_by_testcase.items():
+        if test_case_id not in merged_ids:
+            yield container.test_case_json(test_case_id, queries, detail)
+
+
+def is_sqlite(path):
+    with open(path, 'rb') as report_file:
+        return report_file.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+class JSONReport(object):
+    """
+    Test Result report stored as a single JSON document. The whole document
+    is loaded in memory to read it.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.test_cases_by_id = None
+
+    @classmethod
+    def load(cls, stream):
+        return cls(json.load(stream))
+
+    @classmethod
+    def save(cls, path, container, detail):
+        """
+        Writes the JSON representation of a Test Result
+        :param path: path of the report file
+        :param container: TestResultQueryContainer to write
+        :param detail: If True, will include query details
+        """
+        with open(path, 'w', encoding='utf-8') as json_file:
+            container.dump(json_file, detail=detail)
+
+    @classmethod
+    def merge(cls, path, container, detail):
+        """
+        Writes the JSON representation of a Test Result, keeping the test
+        cases of the existing report that the Test Result doesn't include
+        :param path: path of the report file
+        :param container: TestResultQueryContainer to write
+        :param detail: If True, will include query details
+        """
+        if not os.path.exists(path):
+            return cls.save(path, container, detail)
+
+        temp_path = path + '.tmp'
+        with open_report(path, stream=True) as report:
+            cls.write(temp_path,
+                      iter_merged_test_cases(report, container, detail))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def write(cls, path, test_cases):
+        """
+        Writes a JSON report
+        :param path: path of the report file
+        :param test_cases: iterable of the JSON representation of test cases
+        """
+        with open(path, 'w', encoding='utf-8') as json_file:
+            dump_test_cases(json_file, test_cases)
+
+    @property
+    def total(self):
+        return self.data['total']
+
+    def iter_test_cases(self):
+        """Yields the JSON representation of each test case"""
+        return iter(self.data['test_cases'])
+
+    def get_test_case(self, test_case_id):
+        """
+        Returns the JSON representation of a test case, or None if the report
+        doesn't include it
+        """
+        if self.test_cases_by_id is None:
+            self.test_cases_by_id = {
+                test_case['id']: test_case
+                for test_case in self.data['test_cases']
+            }
+        return self.test_cases_by_id.get(test_case_id)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class JSONStreamParser(object):
+    """
+    Decodes a JSON document from a binary file one value at a time, keeping
+    only the value being decoded in memory.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, binary_file, offset=0):
+        """
+        :param binary_file: file opened in binary mode
+        :param offset: byte offset to start decoding from
+        """
+        binary_file.seek(offset)
+        self.file = binary_file
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.offset = offset
+        self.eof = False
+
+    def read(self):
+        # Grow the buffer geometrically, so values larger than a chunk are
+        # not decoded from the start once per chunk
+        data = self.file.read(max(self.CHUNK_SIZE, len(self.buffer)))
+        self.eof = not data
+        self.buffer += self.decoder.decode(data, final=self.eof)
+
+    def skip_whitespace(self):
+        while True:
+            self.position = WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer) or self.eof:
+                return
+            self.read()
+
+    def consume(self):
+        """Drops the decoded part of the buffer"""
+        consumed = self.buffer[:self.position]
+        self.offset += len(consumed.encode('utf-8'))
+        self.buffer = self.buffer[self.position:]
+        self.position = 0
+
+    def next_char(self):
+        """Returns the next non whitespace character, and skips it"""
+        self.skip_whitespace()
+        if self.position >= len(self.buffer):
+            raise ValueError('Unexpected end of JSON report')
+        char = self.buffer[self.position]
+        self.position += 1
+        return char
+
+    def expect(self, expected):
+        char = self.next_char()
+        if char != expected:
+            raise ValueError('Expected {!r} but got {!r} in JSON '
+                             'report'.format(expected, char))
+
+    def peek(self, expected):
+        """Skips the next character if it is the expected one"""
+        self.skip_whitespace()
+        if self.buffer[self.position:self.position + 1] == expected:
+            self.position += 1
+            return True
+        return False
+
+    def decode(self):
+        """Decodes the next JSON value"""
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer,
+                                                          self.position)
+            except ValueError:
+                if self.eof:
+                    raise
+            else:
+                # A number could continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            self.read()
+
+    def iter_array(self):
+        """
+        Yields the byte offset, byte length and value of each element of an
+        array
+        """
+        self.expect('[')
+        if self.peek(']'):
+            return
+        while True:
+            self.skip_whitespace()
+            self.consume()
+            offset = self.offset
+            value = self.decode()
+            length = len(self.buffer[:self.position].encode('utf-8'))
+            yield (offset, length), value
+            if self.next_char() == ']':
+                return
+            self.position -= 1
+            self.expect(',')
+
+
+class JSONStreamReport(object):
+    """
+    Test Result report stored as a single JSON document, read incrementally.
+    Test cases are decoded one at a time, and looked up through an index of
+    their byte spans in the file, so the document is never held in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Only used to look up test cases, as they can be looked up while the
+        # report is being iterated
+        self.file = open(path, 'rb')
+        self.spans_by_id = None
+
+    def iter_events(self):
+        """
+        Yields ('test_case', (offset, length), test case) for each test case,
+        and (key, None, value) for the rest of the members of the report
+        """
+        with open(self.path, 'rb') as binary_file:
+            parser = JSONStreamParser(binary_file)
+            parser.expect('{')
+            if parser.peek('}'):
+                return
+            while True:
+                key = parser.decode()
+                parser.expect(':')
+                if key == 'test_cases':
+                    for span, test_case in parser.iter_array():
+                        yield 'test_case', span, test_case
+                else:
+                    yield key, None, parser.decode()
+                if parser.next_char() == '}':
+                    return
+
+    @property
+    def total(self):
+        for key, _, value in self.iter_events():
+            if key == 'total':
+                return value
+
+    def iter_test_cases(self):
+        """Yields the JSON representation of each test case"""
+        for key, _, test_case in self.iter_events():
+            if key == 'test_case':
+                yield test_case
+
+    def get_test_case(self, test_case_id):
+        """
+        Returns the JSON representation of a test case, or None if the report
+        doesn't include it
+        """
+        if self.spans_by_id is None:
+            self.spans_by_id = {
+                test_case['id']: span
+                for key, span, test_case in self.iter_events()
+                if key == 'test_case'
+            }
+        span = self.spans_by_id.get(test_case_id)
+        if span is None:
+            return None
+        # Read exactly the bytes of the test case, rather than a whole chunk
+        offset, length = span
+        self.file.seek(offset)
+        return json.loads(self.file.read(length).decode('utf-8'))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SQLiteReport(object):
+    """
+    Test Result report stored as a SQLite database, with one row per test case
+    indexed by its id, so test cases are read one at a time.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+
+    @classmethod
+    def write(cls, path, test_cases):
+        """
+        Writes a SQLite report
+        :param path: path of the report file, which is replaced if it exists
+        :param test_cases: iterable of the JSON representation of test cases
+        """
+        if os.path.exists(path):
+            os.remove(path)
+
+        connection = sqlite3.connect(path)
+        try:
+            with connection:
+                connection.execute(
+                    'CREATE TABLE test_cases (id TEXT PRIMARY KEY, '
+                    'total INTEGER NOT NULL, data TEXT NOT NULL)'
+                )
+                connection.execute(
+                    'CREATE TABLE result (total INTEGER NOT NULL)'
+                )
+                connection.executemany(
+                    'INSERT INTO test_cases (id, total, data) '
+                    'VALUES (?, ?, ?)',
+                    (cls.test_case_row(test_case) for test_case in test_cases)
+                )
+                connection.execute(
+                    'INSERT INTO result (total) '
+                    'SELECT COALESCE(SUM(total), 0) FROM test_cases'
+                )
+        finally:
+            connection.close()
+
+    @classmethod
+    def test_case_row(cls, test_case):
+        return (test_case['id'], test_case['total'],
+                json.dumps(test_case, ensure_ascii=False))
+
+    @classmethod
+    def save(cls, path, container, detail):
+        """
+        Writes the SQLite representation of a Test Result
+        :param path: path of the report file
+        :param container: TestResultQueryContainer to write
+        :param detail: If True, will include query details
+        """
+        cls.write(path, container.iter_test_cases_json(detail))
+
+    @classmethod
+    def merge(cls, path, container, detail):
+        """
+        Writes the SQLite representation of a Test Result, keeping the test
+        cases of the existing report that the Test Result doesn't include.
+        Test cases of existing SQLite reports are updated in place, without
+        rewriting the rest.
+        :param path: path of the report file
+        :param container: TestResultQueryContainer to write
+        :param detail: If True, will include query details
+        """
+        if not os.path.exists(path):
+            return cls.save(path, container, detail)
+
+        if not is_sqlite(path):
+            temp_path = path + '.tmp'
+            with open_report(path, stream=True) as report:
+                cls.write(temp_path,
+                          iter_merged_test_cases(report, container, detail))
+            os.replace(temp_path, path)
+            return
+
+        connection = sqlite3.connect(path)
+        try:
+            with connection:
+                for test_case in container.iter_test_cases_json(detail):
+                    test_case_id, total, data = cls.test_case_row(test_case)
+                    cursor = connection.execute(
+                        'UPDATE test_cases SET total = ?, data = ? '
+                        'WHERE id = ?', (total, data, test_case_id)
+                    )
+                    if cursor.rowcount == 0:
+                        connection.execute(
+                            'INSERT INTO test_cases (id, total, data) '
+                            'VALUES (?, ?, ?)', (test_case_id, total, data)
+                        )
+                connection.execute(
+                    'UPDATE result SET total = '
+                    '(SELECT COALESCE(SUM(total), 0) FROM test_cases)'
+                )
+        finally:
+            connection.close()
+
+    @property
+    def total(self):
+        return self.connection.execute(
+            'SELECT total FROM result'
+        ).fetchone()[0]
+
+    def iter_test_cases(self):
+        """Yields the JSON representation of each test case"""
+        for data, in self.connection.execute(
+                'SELECT data FROM test_cases ORDER BY rowid'):
+            yield json.loads(data)
+
+    def get_test_case(self, test_case_id):
+        """
+        Returns the JSON representation of a test case, or None if the report
+        doesn't include it
+        """
+        row = self.connection.execute(
+            'SELECT data FROM test_cases WHERE id = ?', (test_case_id,)
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+REPORT_CLASSES = {
+    'json': JSONReport,
+    'sqlite': SQLiteReport,
+}
+
+
+def get_report_class(name):
+    """Returns the report class for a FORMAT setting value"""
+    try:
+        return REPORT_CLASSES[name]
+    except KeyError:
+        raise ImproperlyConfigured(
+            'Unknown report format {!r}. Choices are: {}.'.format(
+                name, ', '.join(sorted(REPORT_CLASSES))
+            )
+        )
+
+
+def open_report(path, stream=False):
+    """
+    Opens a report file of any format, detecting it from its contents
+    :param path: path of the report file
+    :param stream: if True, JSON reports are read incrementally instead of
+        being loaded in memory
+    """
+    if is_sqlite(path):
+        return SQLiteReport(path)
+    if stream:
+        return JSONStreamReport(path)
+    with open(path, encoding='utf-8') as report_file:
+        return JSONReport.load(report_file)
@@ -0,0 +1,90 @@
+from functools import lru_cache
+
+from django.core.exceptions import ImproperlyConfigured
+from django.urls import Resolver404, resolve
+from django.utils.module_loading import import_string
+
+
+@lru_cache(maxsize=None)
+def resolve_path(path_info, urlconf=None):
+    """
+    Returns the ResolverMatch of a path, or None if it doesn't match any URL
+    pattern. Results are memoized until the URL configuration changes.
+    """
+    try:
+        return resolve(path_info, urlconf)
+    except Resolver404:
+        return None
+
+
+def get_resolver_match(request):
+    """
+    Returns the ResolverMatch of a request, resolving its path if the request
+    didn't reach the URL resolution, e.g. when a middleware answered it
+    """
+    resolver_match = getattr(request, 'resolver_match', None)
+    if resolver_match is None:
+        resolver_match = resolve_path(request.path_info,
+                                      getattr(request, 'urlconf', None))
+    return resolver_match
+
+
+def path_key(request):
+    """Keys the queries of a request by its path"""
+    return request.method, request.path
+
+
+def route_key(request):
+    """
+    Keys the queries of a request by the route of its URL pattern, so that
+    paths that only differ on their parameters are counted together
+    """
+    resolver_match = get_resolver_match(request)
+    # ResolverMatch.route is only available since Django 2.2
+    route = getattr(resolver_match, 'route', None)
+    if route is None:
+        return path_key(request)
+    return request.method, route
+
+
+def view_name_key(request):
+    """Keys the queries of a request by the name of its URL pattern"""
+    resolver_match = get_resolver_match(request)
+    if resolver_match is None:
+        return path_key(request)
+    return request.method, resolver_match.view_name
+
+
+REQUEST_KEYS = {
+    'path': path_key,
+    'route': route_key,
+    'view_name': view_name_key,
+}
+
+
+def get_request_key(name):
+    """Returns the request key function for a KEY_BY setting value"""
+    try:
+        return REQUEST_KEYS[name]
+    except KeyError:
+        raise ImproperlyConfigured(
+            'Unknown request key {!r}. Choices are: {}.'.format(
+                name, ', '.join(sorted(REQUEST_KEYS))
+            )
+        )
+
+
+def import_request_key(request_key):
+    """
+    Returns the request key function of a REQUEST_KEY setting value
+    :param request_key: dotted path of the function, or the function itself
+    """
+    if callable(request_key):
+        return request_key
+    try:
+        return import_string(request_key)
+    except ImportError as error:
+        raise ImproperlyConfigured(
+            'Cannot import the request key {!r}: {}'.format(request_key,
+                                                            error)
+        )
@@ -0,0 +1,15 @@
+from django.test.runner import DiscoverRunner
+from test_query_counter.apps import RequestQueryCountConfig
+
+
+class QueryCountDiscoverRunner(DiscoverRunner):
+    """
+    Django test runner that counts the queries of the tests, even if
+    django.test was not imported yet when the app was loaded, e.g. with
+    manage.py test
+    """
+
+    def setup_test_environment(self, **kwargs):
+        if RequestQueryCountConfig.enabled():
+            RequestQueryCountConfig.patch_test_environment()
+        super().setup_test_environment(**kwargs)
@@ -4,8 +4,6 @@ from __future__ import absolute_import, unicode_literals
 import os.path
 from tempfile import mkdtemp
 
-import django
-
 DEBUG = True
 USE_TZ = True
 
@@ -16,6 +14,10 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': ':memory:',
+    },
+    'other': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
     }
 }
 
@@ -40,7 +42,6 @@ INSTALLED_APPS = [
 
 SITE_ID = 1
 
-if django.VERSION >= (1, 10):
-    MIDDLEWARE = ()
-else:
-    MIDDLEWARE_CLASSES = ()
+TEST_RUNNER = 'test_query_counter.runner.QueryCountDiscoverRunner'
+
+MIDDLEWARE = ()
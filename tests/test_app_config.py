@@ -1,7 +1,12 @@
+from os import path
+from tempfile import TemporaryDirectory
+from unittest import mock
+
 from django.conf import settings
-from django.test import TestCase, override_settings
+from django.test import TestCase, override_settings, runner, utils
 from test_query_counter.apps import RequestQueryCountConfig
 from test_query_counter.manager import RequestQueryCountManager
+from test_query_counter.runner import QueryCountDiscoverRunner
 
 
 class TestAppConfig(TestCase):
@@ -42,3 +47,81 @@ class TestAppConfig(TestCase):
         with override_settings(MIDDLEWARE='some_nasty_thing'):
             with self.assertRaises(Exception):
                 RequestQueryCountManager.add_middleware()
+
+    def test_settings_resolved_once(self):
+        resolved_settings = RequestQueryCountConfig.get_settings()
+        self.assertIs(RequestQueryCountConfig.get_settings(),
+                      resolved_settings)
+        self.assertEqual(resolved_settings['FORMAT'], 'json')
+        with self.assertRaises(TypeError):
+            resolved_settings['ENABLE'] = False
+
+    def test_settings_changed(self):
+        with override_settings(TEST_QUERY_COUNTER={'FORMAT': 'sqlite'}):
+            self.assertEqual(RequestQueryCountConfig.get_setting('FORMAT'),
+                             'sqlite')
+            self.assertEqual(RequestQueryCountConfig.get_setting('ENABLE'),
+                             True)
+        self.assertEqual(RequestQueryCountConfig.get_setting('FORMAT'),
+                         'json')
+
+    def test_test_environment_patched(self):
+        # The runners call the functions bound in django.test.runner
+        for module in (utils, runner):
+            self.assertTrue(getattr(module.setup_test_environment,
+                                    'query_count_wrapped', False))
+            self.assertTrue(getattr(module.teardown_test_environment,
+                                    'query_count_wrapped', False))
+        setup_test_environment = utils.setup_test_environment
+        RequestQueryCountConfig.patch_test_environment()
+        self.assertIs(utils.setup_test_environment, setup_test_environment)
+
+    def test_runner_patches_test_environment(self):
+        calls = []
+
+        def setup_test_environment(**kwargs):
+            calls.append(kwargs)
+
+        queries = RequestQueryCountManager.queries
+        baseline = RequestQueryCountManager.baseline
+        try:
+            RequestQueryCountManager.queries = None
+            # django.test was not imported when the app was loaded
+            with mock.patch.object(runner, 'setup_test_environment',
+                                   setup_test_environment):
+                QueryCountDiscoverRunner().setup_test_environment()
+                self.assertTrue(runner.setup_test_environment
+                                .query_count_wrapped)
+            self.assertEqual(len(calls), 1)
+            self.assertIsNotNone(RequestQueryCountManager.queries)
+        finally:
+            RequestQueryCountManager.queries = queries
+            RequestQueryCountManager.baseline = baseline
+
+    def test_set_up_once(self):
+        self.assertTrue(RequestQueryCountManager.is_set_up)
+        pre_setup = TestCase._pre_setup
+        RequestQueryCountManager.set_up()
+        self.assertIs(TestCase._pre_setup, pre_setup)
+
+    def test_finish_test_run(self):
+        queries = RequestQueryCountManager.queries
+        baseline = RequestQueryCountManager.baseline
+        try:
+            with TemporaryDirectory() as temp_dir, override_settings(
+                TEST_QUERY_COUNTER={
+                    'SUMMARY_PATH': path.join(temp_dir, 'summary.json'),
+                    'DETAIL_PATH': path.join(temp_dir, 'detail.json'),
+                }
+            ):
+                RequestQueryCountManager.start_test_run()
+                self.assertIsNotNone(RequestQueryCountManager.queries)
+                RequestQueryCountManager.finish_test_run()
+                self.assertIsNone(RequestQueryCountManager.queries)
+                self.assertTrue(path.exists(path.join(temp_dir,
+                                                      'summary.json')))
+                # Without a test run there is nothing to save
+                RequestQueryCountManager.finish_test_run()
+        finally:
+            RequestQueryCountManager.queries = queries
+            RequestQueryCountManager.baseline = baseline
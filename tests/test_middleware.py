@@ -1,18 +1,35 @@
 import os
 from io import StringIO
 from os import path
+from tempfile import TemporaryDirectory
 from unittest import TestLoader, TextTestRunner, mock
 from unittest.mock import MagicMock
+from urllib.request import urlopen
 
-from django.core.exceptions import MiddlewareNotUsed
-from django.test import TestCase, override_settings
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.test import (LiveServerTestCase, RequestFactory, TestCase,
+                         override_settings)
 from django.test.runner import DiscoverRunner
 from test_query_counter.apps import RequestQueryCountConfig
 from test_query_counter.manager import RequestQueryCountManager
 from test_query_counter.middleware import Middleware
+from test_query_counter.query_count import (TestCaseQueryCountContainer,
+                                            TestResultQueryContainer)
+from test_query_counter.request_keys import resolve_path, route_key
+from tests.utils import run_test_case, run_test_foo
+
+
+def operation_key(request):
+    return 'operation {}'.format(request.META.get('HTTP_X_OPERATION'))
+
+
+def version_key(request):
+    return (request.method,
+            '{} v{}'.format(request.path, request.META['HTTP_X_VERSION']))
 
 
 class TestMiddleWare(TestCase):
+    databases = {'default', 'other'}
 
     def setUp(self):
         # Simple class that doesn't output to the standard output
@@ -102,3 +119,267 @@ class TestMiddleWare(TestCase):
         self.assertTrue(path.exists(
             RequestQueryCountConfig.get_setting('DETAIL_PATH'))
         )
+
+    @override_settings(TEST_QUERY_COUNTER={'CAPTURE': 'unknown'})
+    def test_unknown_capture(self):
+        mock_get_response = object()
+        with self.assertRaises(ImproperlyConfigured):
+            Middleware(mock_get_response)
+
+    def run_capture_test(self):
+        class Test(TestCase):
+            databases = {'default', 'other'}
+
+            def test_foo(self):
+                self.client.get('/url-1')
+                self.client.get('/url-other')
+
+        return run_test_foo(self.test_runner, Test)
+
+    @override_settings(TEST_QUERY_COUNTER={'CAPTURE': 'execute_wrapper'})
+    def test_execute_wrapper_capture(self):
+        container = self.run_capture_test()
+        self.assertEqual(container.total, 4)
+        queries = container.queries_by_api_method[('GET', '/url-1', 'default')]
+        self.assertEqual(len(queries), 1)
+        # the shapes of the queries are not kept with them
+        self.assertEqual(queries[0], {'sql': "SELECT 'foo'",
+                                      'time': queries[0]['time']})
+
+    @override_settings(TEST_QUERY_COUNTER={'CAPTURE': 'execute_wrapper',
+                                           'DETAIL_LEVEL': 'count'})
+    def test_execute_wrapper_count_capture(self):
+        container = self.run_capture_test()
+        self.assertEqual(container.queries_by_api_method, {
+            ('GET', '/url-1', 'default'): 1,
+            ('GET', '/url-other', 'default'): 1,
+            ('GET', '/url-other', 'other'): 2,
+        })
+
+    def test_multiple_databases_capture(self):
+        container = self.run_capture_test()
+        self.assertEqual(
+            len(container.queries_by_api_method[
+                ('GET', '/url-other', 'other')]),
+            2
+        )
+
+    @override_settings(TEST_QUERY_COUNTER={'DATABASES': ['other']})
+    def test_databases_setting(self):
+        container = self.run_capture_test()
+        self.assertEqual(
+            sorted(container.queries_by_api_method.keys()),
+            [('GET', '/url-other', 'other')]
+        )
+
+    @override_settings(TEST_QUERY_COUNTER={
+        'EXCLUDE': ['^/url-1$', {'path': 'other', 'method': 'post'}]
+    })
+    def test_global_exclude(self):
+        container = self.run_capture_test()
+        self.assertEqual(
+            sorted(container.queries_by_api_method.keys()),
+            [('GET', '/url-other', 'default'), ('GET', '/url-other', 'other')]
+        )
+
+    def test_global_exclude_setting_changed(self):
+        matcher = RequestQueryCountConfig.get_exclusion_matcher()
+        self.assertIs(RequestQueryCountConfig.get_exclusion_matcher(),
+                      matcher)
+        with override_settings(TEST_QUERY_COUNTER={'EXCLUDE': ['url-1']}):
+            self.assertTrue(RequestQueryCountConfig.get_exclusion_matcher()
+                            .matches('GET', '/url-1'))
+        self.assertFalse(RequestQueryCountConfig.get_exclusion_matcher()
+                         .matches('GET', '/url-1'))
+
+    def run_baseline_test(self, baseline_total):
+        class Test(TestCase):
+            def test_foo(self):
+                self.client.get('/url-1')
+                self.client.get('/url-1')
+
+        baseline = TestResultQueryContainer()
+        baseline.add(
+            Test('test_foo').id(),
+            TestCaseQueryCountContainer({
+                ('GET', '/url-1', 'default'): baseline_total
+            })
+        )
+
+        with TemporaryDirectory() as temp_dir:
+            baseline_path = path.join(temp_dir, 'baseline.json')
+            with open(baseline_path, 'w') as baseline_file:
+                baseline.dump(baseline_file, False)
+
+            settings = {'DATABASES': ['default'],
+                        'BASELINE_PATH': baseline_path}
+            with override_settings(TEST_QUERY_COUNTER=settings):
+                RequestQueryCountManager.baseline = \
+                    RequestQueryCountManager.load_baseline()
+                try:
+                    result, _ = run_test_case(self.test_runner, Test)
+                    return result
+                finally:
+                    RequestQueryCountManager.baseline = None
+
+    def test_baseline(self):
+        result = self.run_baseline_test(2)
+        self.assertEqual(result.errors, [])
+        self.assertEqual(result.failures, [])
+
+    def test_baseline_exceeded(self):
+        result = self.run_baseline_test(1)
+        (test, traceback), = result.failures
+        self.assertIn('GET /url-1. Expected at most 1 queries but got 2 '
+                      'queries', traceback)
+
+    def test_baseline_missing(self):
+        with override_settings(TEST_QUERY_COUNTER={
+                'BASELINE_PATH': 'reports/missing.json'}):
+            self.assertIsNone(RequestQueryCountManager.load_baseline())
+
+    def run_request_key_test(self):
+        class Test(TestCase):
+            def test_foo(self):
+                self.client.get('/orders/17')
+                self.client.get('/orders/18')
+                self.client.get('/missing')
+
+        return run_test_foo(self.test_runner, Test)
+
+    @override_settings(TEST_QUERY_COUNTER={'DATABASES': ['default'],
+                                           'DETAIL_LEVEL': 'count'})
+    def test_key_by_path(self):
+        self.assertEqual(self.run_request_key_test().queries_by_api_method, {
+            ('GET', '/orders/17', 'default'): 1,
+            ('GET', '/orders/18', 'default'): 1,
+            ('GET', '/missing', 'default'): 0,
+        })
+
+    @override_settings(TEST_QUERY_COUNTER={'DATABASES': ['default'],
+                                           'DETAIL_LEVEL': 'count',
+                                           'KEY_BY': 'route'})
+    def test_key_by_route(self):
+        self.assertEqual(self.run_request_key_test().queries_by_api_method, {
+            ('GET', 'orders/<int:pk>', 'default'): 2,
+            ('GET', '/missing', 'default'): 0,
+        })
+
+    @override_settings(TEST_QUERY_COUNTER={'DATABASES': ['default'],
+                                           'DETAIL_LEVEL': 'count',
+                                           'KEY_BY': 'view_name'})
+    def test_key_by_view_name(self):
+        self.assertEqual(self.run_request_key_test().queries_by_api_method, {
+            ('GET', 'order', 'default'): 2,
+            ('GET', '/missing', 'default'): 0,
+        })
+
+    @override_settings(TEST_QUERY_COUNTER={'KEY_BY': 'unknown'})
+    def test_unknown_key_by(self):
+        mock_get_response = object()
+        with self.assertRaises(ImproperlyConfigured):
+            Middleware(mock_get_response)
+
+    def test_route_key_without_resolver_match(self):
+        request = RequestFactory().get('/orders/17')
+        self.assertEqual(route_key(request), ('GET', 'orders/<int:pk>'))
+        self.assertIs(resolve_path('/orders/18'), resolve_path('/orders/18'))
+
+    def run_custom_request_key_test(self):
+        class Test(TestCase):
+            def test_foo(self):
+                self.client.get('/url-1', HTTP_X_OPERATION='foo',
+                                HTTP_X_VERSION='1')
+                self.client.get('/url-2', HTTP_X_OPERATION='foo',
+                                HTTP_X_VERSION='2')
+                self.client.post('/url-1', HTTP_X_OPERATION='bar',
+                                 HTTP_X_VERSION='2')
+
+        return run_test_foo(self.test_runner, Test)
+
+    @override_settings(TEST_QUERY_COUNTER={
+        'DATABASES': ['default'], 'DETAIL_LEVEL': 'count',
+        'REQUEST_KEY': 'tests.test_middleware.operation_key'
+    })
+    def test_request_key_path(self):
+        container = self.run_custom_request_key_test()
+        self.assertEqual(container.queries_by_api_method, {
+            ('GET', 'operation foo', 'default'): 2,
+            ('POST', 'operation bar', 'default'): 1,
+        })
+
+    @override_settings(TEST_QUERY_COUNTER={
+        'DATABASES': ['default'], 'DETAIL_LEVEL': 'count',
+        'KEY_BY': 'route', 'REQUEST_KEY': version_key
+    })
+    def test_request_key_api_call(self):
+        container = self.run_custom_request_key_test()
+        self.assertEqual(container.queries_by_api_method, {
+            ('GET', '/url-1 v1', 'default'): 1,
+            ('GET', '/url-2 v2', 'default'): 1,
+            ('POST', '/url-1 v2', 'default'): 1,
+        })
+
+    @override_settings(TEST_QUERY_COUNTER={
+        'REQUEST_KEY': 'tests.test_middleware.missing_key'
+    })
+    def test_unknown_request_key(self):
+        mock_get_response = object()
+        with self.assertRaises(ImproperlyConfigured):
+            Middleware(mock_get_response)
+
+    @override_settings(TEST_QUERY_COUNTER={'DATABASES': ['default'],
+                                           'DETAIL_LEVEL': 'count'})
+    def test_async_client(self):
+        class Test(TestCase):
+            async def test_foo(self):
+                await self.async_client.get('/url-async')
+                await self.async_client.get('/url-1')
+
+        container = run_test_foo(self.test_runner, Test)
+        self.assertEqual(container.queries_by_api_method, {
+            ('GET', '/url-async', 'default'): 1,
+            ('GET', '/url-1', 'default'): 1,
+        })
+
+    @override_settings(TEST_QUERY_COUNTER={'DATABASES': ['default'],
+                                           'DETAIL_LEVEL': 'count'})
+    def test_request_outliving_test(self):
+        middleware = Middleware(lambda request: None)
+        container = TestCaseQueryCountContainer()
+        request = RequestFactory().get('/url-1')
+        with mock.patch.object(RequestQueryCountManager,
+                               'get_testcase_container',
+                               return_value=container):
+            middleware.process_request(request)
+        # the test finished before the response
+        with mock.patch.object(RequestQueryCountManager,
+                               'get_testcase_container', return_value=None):
+            response = middleware.process_response(request, 'response')
+        self.assertEqual(response, 'response')
+        self.assertEqual(container.queries_by_api_method, {
+            ('GET', '/url-1', 'default'): 0,
+        })
+
+    @override_settings(TEST_QUERY_COUNTER={'DATABASES': ['default'],
+                                           'DETAIL_LEVEL': 'count'},
+                       STATIC_URL='/static/')
+    def test_live_server(self):
+        class Test(LiveServerTestCase):
+            def test_foo(self):
+                for _ in range(2):
+                    with urlopen(self.live_server_url + '/url-1') as response:
+                        self.assertEqual(response.read(), b'view1')
+
+        result, queries = run_test_case(self.test_runner, Test)
+        self.assertEqual(result.errors + result.failures, [])
+        container, = queries.queries_by_testcase.values()
+        self.assertEqual(container.queries_by_api_method, {
+            ('GET', '/url-1', 'default'): 2,
+        })
+        # The server threads report into the outer test again
+        self.assertIs(
+            RequestQueryCountManager.shared_state.get(
+                RequestQueryCountManager.LOCAL_TESTCASE_CONTAINER_NAME),
+            RequestQueryCountManager.get_testcase_container()
+        )
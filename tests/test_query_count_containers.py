@@ -1,7 +1,15 @@
+import json
+import time
+from io import StringIO
+
 from django.test import TestCase
 
-from test_query_counter.query_count import (TestCaseQueryContainer,
-                                            TestResultQueryContainer)
+from test_query_counter.query_count import (QueryCountExclusion,
+                                            QueryCountExclusionMatcher,
+                                            TestCaseQueryContainer,
+                                            TestCaseQueryCountContainer,
+                                            TestResultQueryContainer,
+                                            fingerprint)
 
 
 class MockRequest(object):
@@ -55,7 +63,10 @@ class QueryCountContainersTestCase(TestCase):
                 {
                     'method': 'options',
                     'path': 'request_path',
-                    'total': 1
+                    'database': 'default',
+                    'total': 1,
+                    'time': {'total': 0.02, 'max': 0.02, 'p95': 0.02},
+                    'duplicates': []
                 }
             ]
         })
@@ -66,7 +77,10 @@ class QueryCountContainersTestCase(TestCase):
                 {
                     'method': 'options',
                     'path': 'request_path',
+                    'database': 'default',
                     'total': 1,
+                    'time': {'total': 0.02, 'max': 0.02, 'p95': 0.02},
+                    'duplicates': [],
                     'queries': [
                         {'sql': 'SELECT * FROM some_table', 'time': 0.02}
                     ]
@@ -149,3 +163,253 @@ class QueryCountContainersTestCase(TestCase):
             json_obj['test_cases'][0]['id'],
             'some.test.test_function'
         )
+
+    def test_result_pop(self):
+        result_container = TestResultQueryContainer()
+        test_case_container = TestCaseQueryContainer()
+        test_case_container.add(
+            MockRequest('get', 'some_path'),
+            [
+                {'sql': 'SELECT * FROM a_table', 'time': 0.02},
+            ]
+        )
+        result_container.add('some.test.test_function', test_case_container)
+
+        popped = result_container.pop('some.test.test_function')
+        self.assertEqual(popped.total, 1)
+        self.assertEqual(result_container.total, 0)
+        self.assertIsNone(result_container.pop('some.test.test_function'))
+
+    def test_result_dump(self):
+        result_container = TestResultQueryContainer()
+        dumped = StringIO()
+        result_container.dump(dumped, detail=True)
+        self.assertEqual(
+            dumped.getvalue(),
+            json.dumps(result_container.get_json(detail=True), indent=4,
+                       sort_keys=True)
+        )
+
+        for test_case_id in ('some.test.test_function', 'some.test.test_2'):
+            test_case_container = TestCaseQueryContainer()
+            test_case_container.add(
+                MockRequest('get', 'some_path'),
+                [
+                    {'sql': 'SELECT * FROM a_table', 'time': 0.02},
+                ]
+            )
+            result_container.add(test_case_id, test_case_container)
+
+        for detail in (False, True):
+            dumped = StringIO()
+            result_container.dump(dumped, detail=detail)
+            self.assertEqual(
+                dumped.getvalue(),
+                json.dumps(result_container.get_json(detail=detail),
+                           indent=4, sort_keys=True)
+            )
+
+    def test_count_container(self):
+        container = TestCaseQueryCountContainer()
+        container.add(MockRequest('get', 'request_path'), 2)
+        container.add(MockRequest('get', 'request_path'), 3)
+        self.assertEqual(container.total, 5)
+        self.assertEqual(container.get_json(detail=True), {
+            'total': 5,
+            'queries': [
+                {
+                    'method': 'get',
+                    'path': 'request_path',
+                    'database': 'default',
+                    'total': 5
+                }
+            ]
+        })
+
+        result_container = TestResultQueryContainer()
+        result_container.add('some.test.test_function', container)
+        self.assertIsInstance(
+            result_container.queries_by_testcase['some.test.test_function'],
+            TestCaseQueryCountContainer
+        )
+        self.assertEqual(result_container.total, 5)
+
+    def test_case_add_databases(self):
+        container = TestCaseQueryContainer()
+        request = MockRequest('get', 'request_path')
+        container.add(request, [{'sql': 'SELECT 1', 'time': 0.02}])
+        container.add(request, [{'sql': 'SELECT 2', 'time': 0.02}],
+                      'other')
+        # the same request is only recorded once per database
+        container.add(request, [{'sql': 'SELECT 3', 'time': 0.02}],
+                      'other')
+
+        self.assertEqual(container.total, 2)
+        self.assertEqual(
+            sorted(container.queries_by_api_method.keys()),
+            [('get', 'request_path', 'default'),
+             ('get', 'request_path', 'other')]
+        )
+
+    def test_case_add_empty_databases(self):
+        for container, no_queries in ((TestCaseQueryContainer(), []),
+                                      (TestCaseQueryCountContainer(), 0)):
+            request = MockRequest('get', 'request_path')
+            container.add(request, no_queries)
+            container.add(request, no_queries, 'other')
+
+            # requests without queries are only kept on the default database
+            self.assertEqual(list(container.queries_by_api_method.keys()),
+                             [('get', 'request_path', 'default')])
+
+    def test_case_time_json(self):
+        self.assertEqual(TestCaseQueryContainer.time_json([]), {
+            'total': 0, 'max': 0, 'p95': 0
+        })
+        queries = [
+            {'sql': 'SELECT * FROM some_table', 'time': '0.001'}
+            for _ in range(19)
+        ] + [{'sql': 'SELECT * FROM some_table', 'time': '0.500'}]
+        self.assertEqual(TestCaseQueryContainer.time_json(queries), {
+            'total': 0.519, 'max': 0.5, 'p95': 0.001
+        })
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM t1  WHERE id = 12 AND name = 'o''k' "
+                        "AND t1.kind IN (1, 2, 3)"),
+            'SELECT * FROM t1 WHERE id = ? AND name = ? AND t1.kind IN (...)'
+        )
+        self.assertEqual(
+            fingerprint('SELECT * FROM "t1" WHERE "t1"."id" = %s'),
+            'SELECT * FROM "t1" WHERE "t1"."id" = ?'
+        )
+
+    def test_case_duplicates_json(self):
+        queries = [
+            {'sql': 'SELECT * FROM item WHERE id = {}'.format(i),
+             'time': '0.001'}
+            for i in range(3)
+        ] + [
+            {'sql': 'SELECT * FROM order WHERE id = 1', 'time': '0.001'},
+            {'sql': 'SELECT * FROM user WHERE id = 1', 'time': '0.001'},
+            {'sql': 'SELECT * FROM user WHERE id = 2', 'time': '0.001'},
+        ]
+        self.assertEqual(TestCaseQueryContainer.duplicates_json(queries), [
+            {'sql': 'SELECT * FROM item WHERE id = ?', 'count': 3},
+            {'sql': 'SELECT * FROM user WHERE id = ?', 'count': 2},
+        ])
+
+    def test_case_filtered_total(self):
+        container = TestCaseQueryContainer()
+        container.add(
+            MockRequest('get', 'request_path'),
+            [
+                {'sql': 'SELECT * FROM some_table', 'time': 0.02},
+                {'sql': 'SELECT * FROM some_other_table', 'time': 0.01}
+            ]
+        )
+        container.add(
+            MockRequest('post', 'request_path'),
+            [
+                {'sql': 'SELECT * FROM some_table', 'time': 0.02},
+            ]
+        )
+        self.assertEqual(container.filter_by([]).total, 3)
+
+    def test_result_add_same_test_case(self):
+        result_container = TestResultQueryContainer()
+        for _ in range(1000):
+            test_case_container = TestCaseQueryContainer()
+            test_case_container.add(
+                MockRequest('get', 'some_path'),
+                [
+                    {'sql': 'SELECT * FROM a_table', 'time': 0.02},
+                ]
+            )
+            result_container.add('some.test.test_function',
+                                 test_case_container)
+
+        self.assertEqual(result_container.total, 1000)
+        self.assertEqual(
+            result_container.queries_by_testcase[
+                'some.test.test_function'].total,
+            1000
+        )
+        self.assertEqual(
+            result_container.pop('some.test.test_function').total, 1000
+        )
+        self.assertEqual(result_container.total, 0)
+
+    def test_case_add_by_key_order(self):
+        container = TestCaseQueryContainer()
+        key = ('get', 'request_path', 'default')
+        queries = [{'sql': 'SELECT 1', 'time': 0.02}]
+        container.add_by_key(key, queries)
+        container.add_by_key(key, [{'sql': 'SELECT 2', 'time': 0.02}])
+
+        self.assertEqual(
+            [query['sql'] for query in container.queries_by_api_method[key]],
+            ['SELECT 1', 'SELECT 2']
+        )
+        # the added list is not modified
+        self.assertEqual(len(queries), 1)
+
+    def test_case_add_by_key_scaling(self):
+        def add_by_key_time(adds):
+            best = None
+            for _ in range(3):
+                container = TestCaseQueryContainer()
+                start = time.perf_counter()
+                for _ in range(adds):
+                    container.add_by_key(
+                        ('get', 'request_path', 'default'),
+                        [{'sql': 'SELECT 1', 'time': 0.02}]
+                    )
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            self.assertEqual(container.total, adds)
+            return best
+
+        # Linear scaling makes 4 times the adds take around 4 times as
+        # long, while quadratic scaling would take around 16 times as long
+        ratio = add_by_key_time(10000 * 4) / add_by_key_time(10000)
+        self.assertLess(ratio, 8)
+
+    def test_exclusion_matcher(self):
+        exclusions = [
+            QueryCountExclusion('^/api/', 'get', 2),
+            QueryCountExclusion('orders', '', 5),
+            QueryCountExclusion('/(items)/\\1', 'post|put', 10),
+            QueryCountExclusion('health', 'GET', 100),
+        ]
+        matcher = QueryCountExclusionMatcher(exclusions)
+        requests = [
+            (method, path, num_queries)
+            for method in ('GET', 'POST', 'PUT', 'DELETE')
+            for path in ('/api/users', '/api/orders', '/orders',
+                         '/items/items', '/HEALTH', '/other')
+            for num_queries in (0, 2, 3, 5, 6, 10, 11, 100, 101)
+        ]
+        for method, path, num_queries in requests:
+            self.assertEqual(
+                matcher.is_excluded(method, path, num_queries),
+                bool(TestCaseQueryContainer.excluded(
+                    method, path, [None] * num_queries, exclusions)),
+                (method, path, num_queries)
+            )
+
+        self.assertEqual(matcher.get_count('GET', '/api/orders'), 5)
+        self.assertIsNone(matcher.get_count('DELETE', '/items/items'))
+        self.assertIsNone(
+            QueryCountExclusionMatcher([]).get_count('GET', '/api/orders')
+        )
+
+        # the groups of a path are not renumbered by the exclusions sorted
+        # before it
+        matcher = QueryCountExclusionMatcher([
+            QueryCountExclusion('zzz', '', 100),
+            QueryCountExclusion('/(items)/\\1', '', 10),
+        ])
+        self.assertTrue(matcher.is_excluded('GET', '/items/items', 10))
+        self.assertFalse(matcher.is_excluded('GET', '/items/other', 10))
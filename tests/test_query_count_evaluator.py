@@ -2,9 +2,15 @@ import json
 import re
 from io import StringIO
 
+from django.core.management import CommandError
 from django.test import TestCase
 
-from test_query_counter.query_count import QueryCountEvaluator
+from test_query_counter.management.commands.check_query_count import Command
+from test_query_counter.query_count import (BudgetViolation,
+                                            DuplicateViolation,
+                                            QueryCountBudget,
+                                            QueryCountEvaluator,
+                                            TimeViolation, Violation)
 
 
 class TestQueryCountEvaluator(TestCase):
@@ -251,3 +257,158 @@ class TestQueryCountEvaluator(TestCase):
             re.search(r'In test case test-3',
                       evaluator.stream.getvalue())
         )
+
+    def test_databases(self):
+        violations = list(self.evaluator.compare_test_cases(
+            'test-case-id',
+            [
+                {
+                    "method": "get",
+                    "path": "/api/events",
+                    "total": 100
+                },
+                {
+                    "method": "get",
+                    "path": "/api/events",
+                    "database": "replica",
+                    "total": 120
+                }
+            ],
+            [
+                {
+                    "method": "get",
+                    "path": "/api/events",
+                    "database": "default",
+                    "total": 100
+                },
+                {
+                    "method": "get",
+                    "path": "/api/events",
+                    "database": "replica",
+                    "total": 100
+                }
+            ]
+        ))
+
+        self.assertEqual(len(violations), 1)
+        self.assertEqual(violations[0].database, 'replica')
+
+    def test_time_threshold(self):
+        evaluator = QueryCountEvaluator(10, self.make([]), self.make([]),
+                                        StringIO(), time_threshold=50)
+        current = [
+            {
+                "method": "get",
+                "path": "/api/events",
+                "total": 1,
+                "time": {"total": 0.4, "max": 0.4, "p95": 0.4}
+            }
+        ]
+        last = [
+            {
+                "method": "get",
+                "path": "/api/events",
+                "total": 10,
+                "time": {"total": 0.2, "max": 0.02, "p95": 0.02}
+            }
+        ]
+
+        violation, = evaluator.compare_test_cases('test-case-id', current,
+                                                  last)
+        self.assertIsInstance(violation, TimeViolation)
+        self.assertAlmostEqual(violation.threshold, 0.3)
+        self.assertEqual(violation.total, 0.4)
+        self.assertIn('Expected at most 0.300s of queries but got 0.400s',
+                      violation.get_message())
+
+        # query times are only compared when there is a time threshold
+        self.assertFalse(any(self.evaluator.compare_test_cases(
+            'test-case-id', current, last)))
+
+    def test_time_threshold_min_increase(self):
+        evaluator = QueryCountEvaluator(10, self.make([]), self.make([]),
+                                        StringIO(), time_threshold=50)
+
+        def make_queries(time):
+            return [
+                {
+                    "method": "get",
+                    "path": "/api/events",
+                    "total": 1,
+                    "time": {"total": time, "max": time, "p95": time}
+                }
+            ]
+
+        # increases below the minimum are tolerated, even from no time
+        self.assertFalse(any(evaluator.compare_test_cases(
+            'test-case-id', make_queries(0.001), make_queries(0.0))))
+        self.assertFalse(any(evaluator.compare_test_cases(
+            'test-case-id', make_queries(0.05), make_queries(0.0))))
+
+        violation, = evaluator.compare_test_cases(
+            'test-case-id', make_queries(0.051), make_queries(0.0)
+        )
+        self.assertIsInstance(violation, TimeViolation)
+        self.assertAlmostEqual(violation.threshold, 0.05)
+
+    def test_duplicate_threshold(self):
+        evaluator = QueryCountEvaluator(10, self.make([]), self.make([]),
+                                        StringIO(), duplicate_threshold=5)
+        current = [
+            {
+                "method": "get",
+                "path": "/api/events",
+                "total": 12,
+                "duplicates": [
+                    {"sql": "SELECT * FROM item WHERE id = ?", "count": 10},
+                    {"sql": "SELECT * FROM user WHERE id = ?", "count": 2}
+                ]
+            }
+        ]
+
+        violation, = evaluator.compare_test_cases('test-case-id', current,
+                                                  current)
+        self.assertIsInstance(violation, DuplicateViolation)
+        self.assertEqual(violation.threshold, 5)
+        self.assertEqual(violation.total, 10)
+        self.assertEqual(violation.sql, 'SELECT * FROM item WHERE id = ?')
+
+        # repeated queries are only checked when there is a threshold
+        self.assertFalse(any(self.evaluator.compare_test_cases(
+            'test-case-id', current, current)))
+
+    def test_budgets(self):
+        budgets = QueryCountBudget.load(StringIO(json.dumps([
+            {"path": "^/api/reports", "count": 500},
+            {"path": "^/api/", "method": "post", "count": 20},
+        ])))
+        evaluator = QueryCountEvaluator(10, self.make([]), self.make([]),
+                                        StringIO(), budgets=budgets)
+        current = [
+            {"method": "post", "path": "/api/events", "total": 400},
+            {"method": "get", "path": "/api/events", "total": 400},
+            {"method": "post", "path": "/api/reports", "total": 400},
+        ]
+
+        # new API calls are checked against their budget too
+        violation, = evaluator.compare_test_cases('test-case-id', current, [])
+        self.assertIsInstance(violation, BudgetViolation)
+        self.assertEqual(violation.method, 'post')
+        self.assertEqual(violation.path, '/api/events')
+        self.assertEqual(violation.threshold, 20)
+        self.assertIn('Expected at most 20 queries by budget but got 400',
+                      violation.get_message())
+
+        # budgets are checked in addition to the last run
+        violations = list(evaluator.compare_test_cases(
+            'test-case-id', current,
+            [{"method": "get", "path": "/api/events", "total": 10}]
+        ))
+        self.assertEqual(
+            [violation.__class__ for violation in violations],
+            [BudgetViolation, Violation]
+        )
+
+    def test_budget_file_not_found(self):
+        with self.assertRaisesMessage(CommandError, 'Invalid budget file'):
+            Command.load_budgets('missing_query_budgets.json')
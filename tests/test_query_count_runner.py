@@ -1,14 +1,20 @@
 import os
+import pickle
+import threading
 from io import StringIO
 from os import path
-from unittest import TestLoader, TextTestRunner
+from unittest import TestLoader, TextTestRunner, mock
 
-from django.test import TestCase
-from django.test.runner import DiscoverRunner
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.runner import DiscoverRunner, RemoteTestResult
 from test_query_counter.apps import RequestQueryCountConfig
 from test_query_counter.manager import RequestQueryCountManager
-from test_query_counter.query_count import (TestResultQueryContainer,
+from test_query_counter.query_count import (TestCaseQueryCountContainer,
+                                            TestResultQueryContainer,
+                                            count_queries,
                                             exclude_query_count)
+from tests.utils import run_test_foo
 
 
 class TestRunnerTest(TestCase):
@@ -243,3 +249,212 @@ class TestRunnerTest(TestCase):
                 self.get_id(Test, 'test_foo')].total,
             1
         )
+
+    def test_parallel_worker_events(self):
+        class Test(TestCase):
+            def test_foo(self):
+                self.client.get('/url-1')
+
+        test_foo_id = self.get_id(Test, 'test_foo')
+        parent_queries = RequestQueryCountManager.queries
+        RequestQueryCountManager.queries = TestResultQueryContainer()
+        try:
+            # the worker side ships the queries within the events
+            result = RemoteTestResult()
+            TestLoader().loadTestsFromTestCase(testCaseClass=Test).run(result)
+            self.assertNotIn(
+                test_foo_id,
+                RequestQueryCountManager.queries.queries_by_testcase
+            )
+            events = pickle.loads(pickle.dumps(result.events))
+            query_count_events = [
+                event for event in events
+                if event[0] == RequestQueryCountManager.PARALLEL_EVENT_NAME
+            ]
+            self.assertEqual(len(query_count_events), 1)
+
+            # the parent side merges them back
+            RequestQueryCountManager.add_remote_queries(
+                Test('test_foo'), *query_count_events[0][2:]
+            )
+            self.assertEqual(
+                RequestQueryCountManager.queries.queries_by_testcase[
+                    test_foo_id].total,
+                1
+            )
+        finally:
+            RequestQueryCountManager.queries = parent_queries
+
+    @override_settings(TEST_QUERY_COUNTER={'DETAIL_LEVEL': 'count'})
+    def test_count_detail_level(self):
+        class Test(TestCase):
+            def test_foo(self):
+                self.client.get('/url-1')
+                self.client.get('/url-1')
+
+        container = run_test_foo(self.test_runner, Test)
+        self.assertIsInstance(container, TestCaseQueryCountContainer)
+        self.assertEqual(container.queries_by_api_method, {
+            ('GET', '/url-1', 'default'): 2,
+        })
+
+    def test_exclusion_matcher_cached(self):
+        @exclude_query_count(path='url-1')
+        class Test(TestCase):
+            @exclude_query_count(method='post')
+            def test_foo(self):
+                pass
+
+            def test_bar(self):
+                pass
+
+        foo_matcher = RequestQueryCountManager.get_exclusion_matcher(
+            Test('test_foo'))
+        self.assertIs(
+            RequestQueryCountManager.get_exclusion_matcher(Test('test_foo')),
+            foo_matcher
+        )
+        self.assertEqual(len(foo_matcher.exclusion_list), 2)
+        self.assertEqual(
+            len(RequestQueryCountManager.get_exclusion_matcher(
+                Test('test_bar')).exclusion_list),
+            1
+        )
+
+        class SubTest(Test):
+            pass
+
+        self.assertIsNot(
+            RequestQueryCountManager.get_exclusion_matcher(
+                SubTest('test_foo')),
+            foo_matcher
+        )
+
+    def run_test_body_capture(self):
+        class Test(TestCase):
+            def test_foo(self):
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 'foo'")
+                self.client.get('/url-1')
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 'bar'")
+                self.client.get('/url-1')
+
+        return run_test_foo(self.test_runner, Test)
+
+    @override_settings(TEST_QUERY_COUNTER={'CAPTURE_TEST_BODY': True,
+                                           'DATABASES': ['default']})
+    def test_capture_test_body(self):
+        container = self.run_test_body_capture()
+        body_queries = container.queries_by_api_method[
+            ('TEST', '<body>', 'default')]
+        self.assertEqual([query['sql'] for query in body_queries],
+                         ["SELECT 'foo'", "SELECT 'bar'"])
+        self.assertEqual(
+            len(container.queries_by_api_method[
+                ('GET', '/url-1', 'default')]),
+            2
+        )
+        self.assertEqual(container.total, 4)
+
+    @override_settings(TEST_QUERY_COUNTER={'CAPTURE_TEST_BODY': True,
+                                           'CAPTURE': 'execute_wrapper',
+                                           'DETAIL_LEVEL': 'count',
+                                           'DATABASES': ['default']})
+    def test_capture_test_body_execute_wrapper(self):
+        container = self.run_test_body_capture()
+        self.assertEqual(container.queries_by_api_method, {
+            ('TEST', '<body>', 'default'): 2,
+            ('GET', '/url-1', 'default'): 2,
+        })
+
+    @override_settings(TEST_QUERY_COUNTER={'CAPTURE_TEST_BODY': True,
+                                           'DETAIL_LEVEL': 'count',
+                                           'DATABASES': ['default']})
+    def test_capture_test_body_full_queries_log(self):
+        class Test(TestCase):
+            def test_foo(self):
+                with connection.cursor() as cursor:
+                    for _ in range(connection.queries_limit + 500):
+                        cursor.execute("SELECT 'foo'")
+                self.client.get('/url-1')
+
+        container = run_test_foo(self.test_runner, Test)
+        # The requests still get their own queries log
+        self.assertEqual(container.queries_by_api_method, {
+            ('TEST', '<body>', 'default'): connection.queries_limit + 500,
+            ('GET', '/url-1', 'default'): 1,
+        })
+
+    @override_settings(TEST_QUERY_COUNTER={'CAPTURE_TEST_BODY': True,
+                                           'DETAIL_LEVEL': 'count'})
+    def test_capture_empty_test_body(self):
+        class Test(TestCase):
+            def test_foo(self):
+                self.client.get('/url-1')
+
+        container = run_test_foo(self.test_runner, Test)
+        self.assertNotIn(('TEST', '<body>', 'default'),
+                         container.queries_by_api_method)
+
+    def test_test_body_not_captured_by_default(self):
+        container = self.run_test_body_capture()
+        self.assertNotIn(('TEST', '<body>', 'default'),
+                         container.queries_by_api_method)
+
+    @override_settings(TEST_QUERY_COUNTER={'DATABASES': ['default']})
+    def test_count_queries(self):
+        @count_queries('select')
+        def select(*values):
+            with connection.cursor() as cursor:
+                for value in values:
+                    cursor.execute('SELECT %s', [value])
+
+        class Test(TestCase):
+            def test_foo(self):
+                select('foo', 'bar')
+                with count_queries('request'):
+                    self.client.get('/url-1')
+                    select('baz')
+
+        container = run_test_foo(self.test_runner, Test)
+        queries_by_api_method = container.queries_by_api_method
+        self.assertEqual(
+            len(queries_by_api_method[('BLOCK', 'select', 'default')]), 3
+        )
+        # The queries are counted in the innermost block or request only
+        self.assertEqual(queries_by_api_method[('BLOCK', 'request', 'default')],
+                         [])
+        self.assertEqual(
+            container.total,
+            3 + len(queries_by_api_method[('GET', '/url-1', 'default')])
+        )
+
+    def test_count_queries_concurrent_calls(self):
+        entered = threading.Event()
+        exited = threading.Event()
+
+        @count_queries('select')
+        def select(wait_for_exit):
+            if wait_for_exit:
+                entered.set()
+                exited.wait(5)
+            else:
+                # Leaves while the call of the thread is still counting
+                thread = threading.Thread(target=select, args=(True,))
+                thread.start()
+                entered.wait(5)
+                return thread
+
+        thread = select(False)
+        exited.set()
+        thread.join()
+        self.assertEqual(RequestQueryCountManager.get_captures_stack(), [])
+
+    def test_count_queries_outside_test(self):
+        with mock.patch.object(RequestQueryCountManager,
+                               'get_testcase_container', return_value=None):
+            with count_queries('select'):
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 'foo'")
+        self.assertEqual(RequestQueryCountManager.get_captures_stack(), [])
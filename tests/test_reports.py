@@ -0,0 +1,294 @@
+import shutil
+from io import StringIO
+from os import path
+from tempfile import mkdtemp
+from unittest import mock
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import TestCase
+
+from test_query_counter.query_count import (QueryCountEvaluator,
+                                            TestCaseQueryContainer,
+                                            TestResultQueryContainer)
+from test_query_counter.reports import (JSONReport, JSONStreamParser,
+                                        JSONStreamReport, SQLiteReport,
+                                        get_report_class, open_report)
+
+
+class MockRequest(object):
+
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+
+
+class ReportsTestCase(TestCase):
+
+    def setUp(self):
+        self.tempdir = mkdtemp('test_query_counter_reports')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def make_container(self, totals_by_test_case):
+        result_container = TestResultQueryContainer()
+        for test_case_id, total in totals_by_test_case.items():
+            test_case_container = TestCaseQueryContainer()
+            test_case_container.add(
+                MockRequest('get', 'some_path'),
+                [{'sql': 'SELECT * FROM a_table', 'time': 0.02}] * total
+            )
+            result_container.add(test_case_id, test_case_container)
+        return result_container
+
+    def save(self, report_class, name, container, detail=False):
+        report_path = path.join(self.tempdir, name)
+        report_class.save(report_path, container, detail)
+        return report_path
+
+    def test_get_report_class(self):
+        self.assertIs(get_report_class('json'), JSONReport)
+        self.assertIs(get_report_class('sqlite'), SQLiteReport)
+        with self.assertRaises(ImproperlyConfigured):
+            get_report_class('xml')
+
+    def test_json_report(self):
+        container = self.make_container({'test_1': 1, 'test_2': 2})
+        report_path = self.save(JSONReport, 'report.json', container)
+
+        with open_report(report_path) as report:
+            self.assertIsInstance(report, JSONReport)
+            self.assertEqual(report.total, 3)
+            self.assertEqual(
+                [test_case['id'] for test_case in report.iter_test_cases()],
+                ['test_1', 'test_2']
+            )
+            self.assertEqual(report.get_test_case('test_2')['total'], 2)
+            self.assertIsNone(report.get_test_case('test_3'))
+
+    def test_sqlite_report(self):
+        container = self.make_container({'test_1': 1, 'test_2': 2})
+        report_path = self.save(SQLiteReport, 'report.db', container,
+                                detail=True)
+        # saving again replaces the existing report
+        report_path = self.save(SQLiteReport, 'report.db', container,
+                                detail=True)
+
+        with open_report(report_path) as report:
+            self.assertIsInstance(report, SQLiteReport)
+            self.assertEqual(report.total, 3)
+            self.assertEqual(
+                list(report.iter_test_cases()),
+                container.get_json(detail=True)['test_cases']
+            )
+            self.assertEqual(report.get_test_case('test_2')['total'], 2)
+            self.assertIsNone(report.get_test_case('test_3'))
+
+    def test_evaluator_sqlite_reports(self):
+        current_path = self.save(
+            SQLiteReport, 'current.db',
+            self.make_container({'test_1': 12, 'test_2': 2})
+        )
+        last_path = self.save(
+            SQLiteReport, 'last.db',
+            self.make_container({'test_1': 10, 'test_2': 2})
+        )
+
+        with open_report(current_path) as current, \
+                open_report(last_path) as last:
+            violations = QueryCountEvaluator(10, current, last,
+                                             StringIO()).run()
+
+        self.assertEqual(len(violations), 1)
+        self.assertEqual(violations[0].test_case_id, 'test_1')
+
+    def test_json_stream_report(self):
+        container = self.make_container({
+            'test_{}'.format(index): index for index in range(1, 30)
+        })
+        container.add('test_ñandú', TestCaseQueryContainer())
+        report_path = self.save(JSONReport, 'report.json', container,
+                                detail=True)
+
+        # decode values across the boundaries of the chunks
+        with open_report(report_path, stream=True) as report, \
+                mock.patch.object(JSONStreamParser, 'CHUNK_SIZE', 7):
+            self.assertIsInstance(report, JSONStreamReport)
+            self.assertEqual(report.total, container.total)
+            self.assertEqual(
+                list(report.iter_test_cases()),
+                container.get_json(detail=True)['test_cases']
+            )
+            self.assertEqual(report.get_test_case('test_ñandú')['total'], 0)
+            self.assertEqual(report.get_test_case('test_17')['total'], 17)
+            self.assertIsNone(report.get_test_case('test_30'))
+
+    def test_json_stream_report_any_order(self):
+        report_path = path.join(self.tempdir, 'report.json')
+        with open(report_path, 'w') as report_file:
+            report_file.write('{"total": 1, "test_cases": [{"id": "test_1", '
+                              '"queries": [], "total": 1}], "other": null}')
+
+        with open_report(report_path, stream=True) as report:
+            self.assertEqual(report.total, 1)
+            self.assertEqual(report.get_test_case('test_1')['total'], 1)
+
+    def test_evaluator_iter_run(self):
+        current_path = self.save(
+            JSONReport, 'current.json',
+            self.make_container({'test_1': 12, 'test_2': 2})
+        )
+        last_path = self.save(
+            JSONReport, 'last.json',
+            self.make_container({'test_1': 10, 'test_2': 2})
+        )
+
+        stream = StringIO()
+        with open_report(current_path, stream=True) as current, \
+                open_report(last_path, stream=True) as last:
+            violations = QueryCountEvaluator(10, current, last,
+                                             stream).iter_run()
+            violation = next(violations)
+            # the violation is printed before the rest are evaluated
+            self.assertIn('In test case test_1', stream.getvalue())
+            self.assertEqual(violation.test_case_id, 'test_1')
+            self.assertEqual(list(violations), [])
+
+    def assert_merged(self, report_path, report_class):
+        with open_report(report_path) as report:
+            self.assertIsInstance(report, report_class)
+            self.assertEqual(
+                [(test_case['id'], test_case['total'])
+                 for test_case in report.iter_test_cases()],
+                [('test_1', 1), ('test_2', 5), ('test_3', 3)]
+            )
+            self.assertEqual(report.total, 9)
+
+    def test_json_merge(self):
+        report_path = self.save(JSONReport, 'report.json', self.make_container(
+            {'test_1': 1, 'test_2': 2}))
+        JSONReport.merge(report_path,
+                         self.make_container({'test_2': 5, 'test_3': 3}),
+                         False)
+        self.assert_merged(report_path, JSONReport)
+
+    def test_sqlite_merge(self):
+        report_path = self.save(SQLiteReport, 'report.db', self.make_container(
+            {'test_1': 1, 'test_2': 2}))
+        SQLiteReport.merge(report_path,
+                           self.make_container({'test_2': 5, 'test_3': 3}),
+                           False)
+        self.assert_merged(report_path, SQLiteReport)
+
+    def test_merge_other_format(self):
+        report_path = self.save(JSONReport, 'report', self.make_container(
+            {'test_1': 1, 'test_2': 2}))
+        SQLiteReport.merge(report_path,
+                           self.make_container({'test_2': 5, 'test_3': 3}),
+                           False)
+        self.assert_merged(report_path, SQLiteReport)
+
+    def test_merge_missing_report(self):
+        report_path = path.join(self.tempdir, 'report.json')
+        JSONReport.merge(report_path, self.make_container({'test_1': 1}),
+                         False)
+        with open_report(report_path) as report:
+            self.assertEqual(report.total, 1)
+
+    def merge_reports(self, report_paths, output_format='json'):
+        output_path = path.join(self.tempdir, 'merged')
+        stderr = StringIO()
+        call_command('merge_query_count', *report_paths,
+                     output=output_path, format=output_format, stderr=stderr)
+        return output_path, stderr.getvalue()
+
+    def test_merge_command(self):
+        report_paths = [
+            self.save(JSONReport, 'shard_1.json',
+                      self.make_container({'test_1': 1, 'test_2': 2})),
+            self.save(SQLiteReport, 'shard_2.db',
+                      self.make_container({'test_3': 3})),
+        ]
+        output_path, stderr = self.merge_reports(report_paths, 'sqlite')
+        self.assertEqual(stderr, '')
+        with open_report(output_path) as report:
+            self.assertIsInstance(report, SQLiteReport)
+            self.assertEqual(
+                [(test_case['id'], test_case['total'])
+                 for test_case in report.iter_test_cases()],
+                [('test_1', 1), ('test_2', 2), ('test_3', 3)]
+            )
+            self.assertEqual(report.total, 6)
+
+    def test_merge_command_duplicates(self):
+        report_paths = [
+            self.save(JSONReport, 'shard_1.json',
+                      self.make_container({'test_1': 1, 'test_2': 2}),
+                      detail=True),
+            self.save(JSONReport, 'shard_2.json',
+                      self.make_container({'test_2': 3}), detail=True),
+        ]
+        output_path, stderr = self.merge_reports(report_paths)
+        self.assertIn('Test case test_2 found in 2 files', stderr)
+
+        expected = self.make_container({'test_1': 1, 'test_2': 2})
+        expected.add('test_2', self.make_container(
+            {'test_2': 3}).queries_by_testcase['test_2'])
+        with open_report(output_path) as report:
+            self.assertEqual(report.data, expected.get_json(detail=True))
+
+    def test_merge_command_summary_duplicates(self):
+        def make_summary(name, sql, times):
+            test_case_container = TestCaseQueryContainer()
+            test_case_container.add(MockRequest('get', 'some_path'), [
+                {'sql': sql.format(index), 'time': time}
+                for index, time in enumerate(times)
+            ])
+            container = TestResultQueryContainer()
+            container.add('test_1', test_case_container)
+            return self.save(JSONReport, name, container)
+
+        report_paths = [
+            make_summary('shard_1.json', 'SELECT * FROM a WHERE id = {}',
+                         ['0.010', '0.030']),
+            make_summary('shard_2.json', 'SELECT * FROM a WHERE id = {}',
+                         ['0.020', '0.001', '0.001']),
+        ]
+        output_path, stderr = self.merge_reports(report_paths)
+        self.assertIn('Test case test_1 found in 2 files', stderr)
+
+        with open_report(output_path) as report:
+            test_case, = report.iter_test_cases()
+        self.assertEqual(test_case['total'], 5)
+        element, = test_case['queries']
+        self.assertEqual(element['total'], 5)
+        self.assertEqual(element['time']['total'], 0.062)
+        self.assertEqual(element['time']['max'], 0.03)
+        self.assertEqual(element['duplicates'], [
+            {'sql': 'SELECT * FROM a WHERE id = ?', 'count': 5}
+        ])
+
+    def test_merge_command_duplicates_across_chunks(self):
+        report_paths = [
+            self.save(JSONReport, 'shard_1.json', self.make_container({
+                'test_{}'.format(index): index for index in range(1, 30)
+            })),
+            self.save(JSONReport, 'shard_2.json',
+                      self.make_container({'test_1': 3})),
+        ]
+        # the duplicate is looked up before the rest of the first file is
+        # read
+        with mock.patch.object(JSONStreamParser, 'CHUNK_SIZE', 7):
+            output_path, stderr = self.merge_reports(report_paths)
+        self.assertIn('Test case test_1 found in 2 files', stderr)
+
+        with open_report(output_path) as report:
+            self.assertEqual(
+                [(test_case['id'], test_case['total'])
+                 for test_case in report.iter_test_cases()],
+                [('test_1', 4)] + [
+                    ('test_{}'.format(index), index)
+                    for index in range(2, 30)
+                ]
+            )
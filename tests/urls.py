@@ -2,11 +2,15 @@
 from __future__ import absolute_import, unicode_literals
 
 from django.conf.urls import url
+from django.urls import path
 
-from tests.views import view1, view2
+from tests.views import view1, view2, view_async, view_order, view_other
 
 urlpatterns = [
     url(r'^url-1$', view1, name='view-1'),
     url(r'^url-2$', view2, name='view-2'),
-    url(r'^url-3$', view2, name='view-3')
+    url(r'^url-3$', view2, name='view-3'),
+    url(r'^url-other$', view_other, name='view-other'),
+    path('orders/<int:pk>', view_order, name='order'),
+    path('url-async', view_async, name='view-async')
 ]
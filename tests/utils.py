@@ -0,0 +1,36 @@
+from unittest import TestLoader
+
+from test_query_counter.manager import RequestQueryCountManager
+from test_query_counter.query_count import TestResultQueryContainer
+
+
+def run_test_case(test_runner, test_class):
+    """
+    Runs the tests of a test case class in a fresh test result container, so
+    their queries are not added to the running test result
+    :param test_runner: DiscoverRunner to run the tests with
+    :param test_class: TestCase class to run
+    :return: the unittest result, and the TestResultQueryContainer with the
+        queries of the tests
+    """
+    parent_queries = RequestQueryCountManager.queries
+    RequestQueryCountManager.queries = TestResultQueryContainer()
+    try:
+        result = test_runner.run_suite(
+            TestLoader().loadTestsFromTestCase(testCaseClass=test_class)
+        )
+        return result, RequestQueryCountManager.queries
+    finally:
+        RequestQueryCountManager.queries = parent_queries
+
+
+def run_test_foo(test_runner, test_class):
+    """
+    Runs the tests of a test case class, and returns the query container of
+    its test_foo method
+    """
+    _, queries = run_test_case(test_runner, test_class)
+    return queries.queries_by_testcase[
+        '{}.{}.test_foo'.format(test_class.__module__,
+                                test_class.__qualname__)
+    ]
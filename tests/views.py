@@ -1,4 +1,5 @@
-from django.db import connection
+from asgiref.sync import sync_to_async
+from django.db import connection, connections
 from django.http import HttpResponse
 
 
@@ -21,3 +22,27 @@ def view3(request):
         cursor.execute("SELECT 'baz'")
         cursor.fetchone()
     return HttpResponse('view2')
+
+
+def view_order(request, pk):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT %s", [pk])
+        cursor.fetchone()
+    return HttpResponse('view_order')
+
+
+def view_other(request):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 'foo'")
+        cursor.fetchone()
+    with connections['other'].cursor() as cursor:
+        cursor.execute("SELECT 'bar'")
+        cursor.fetchone()
+        cursor.execute("SELECT 'baz'")
+        cursor.fetchone()
+    return HttpResponse('view_other')
+
+
+async def view_async(request):
+    await sync_to_async(view1)(request)
+    return HttpResponse('view_async')